@@ -1,8 +1,18 @@
+# stdlib
+from array import array
+import heapq
 import logging
+import re
 from time import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from checks.metric_types import MetricTypes
 from config import get_histogram_aggregates, get_histogram_percentiles
+from utils.sketches import HyperLogLog, QuantileSketch, SpaceSaving
 
 log = logging.getLogger(__name__)
 
@@ -18,15 +28,183 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Number of distinct metric lines (everything but the value) whose parsed
+# context is kept by the aggregator
+CONTEXT_CACHE_SIZE_DEFAULT = 10000
+
+# Tags of the context that gets the points of a metric over its context budget
+OVERFLOW_TAGS = ('overflow:true',)
+CONTEXT_OVERFLOW_POLICIES = ('aggregate', 'drop')
+
 class Infinity(Exception): pass
 class UnknownValue(Exception): pass
 
 
+class ContextCache(object):
+    """
+    A bounded map with an approximate LRU eviction: entries live in a hot
+    and a cold generation, a hit in the cold one promotes the entry and when
+    the hot generation is full the cold one is dropped. That keeps lookups
+    down to one or two dict accesses.
+    """
+
+    def __init__(self, size):
+        self.generation_size = max(1, int(size) // 2)
+        self.hot = {}
+        self.cold = {}
+
+    def get(self, key):
+        value = self.hot.get(key)
+        if value is None:
+            value = self.cold.get(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        hot = self.hot
+        if len(hot) >= self.generation_size:
+            self.cold = hot
+            self.hot = hot = {}
+        hot[key] = value
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+
+class TagSetTable(object):
+    """
+    Interning table for the tags of the aggregated contexts: each distinct
+    tag string and each distinct tag tuple is stored once, and every context
+    sharing them references the same objects.
+    """
+
+    def __init__(self):
+        self.strings = {}
+        self.tag_sets = {}
+        # Tags referenced by the live contexts, duplicates included, as of
+        # the last call to `prune` or `count_references`
+        self.references = 0
+
+    def intern(self, tags):
+        """ Return the canonical tuple equal to `tags`, a tuple of strings. """
+        tag_set = self.tag_sets.get(tags)
+        if tag_set is None:
+            strings = self.strings
+            tag_set = tuple([strings.setdefault(tag, tag) for tag in tags])
+            self.tag_sets[tag_set] = tag_set
+        return tag_set
+
+    def prune(self, live_tag_sets):
+        """ Forget the tags no longer referenced, given the tag tuples of the
+        live contexts. """
+        self.strings = {}
+        self.tag_sets = {}
+        self.references = 0
+        for tags in live_tag_sets:
+            self.intern(tags)
+            self.references += len(tags)
+
+    def count_references(self, live_tag_sets):
+        self.references = sum(len(tags) for tags in live_tag_sets)
+
+    def dedup_ratio(self):
+        """ Number of tags referenced by the contexts per tag string stored. """
+        if not self.strings:
+            return 0
+        return round(float(self.references) / len(self.strings), 2)
+
+    def __len__(self):
+        return len(self.tag_sets)
+
+
+def _split_rules(rules):
+    if not rules:
+        return []
+    if isinstance(rules, basestring):
+        rules = rules.split(',')
+    return [rule.strip() for rule in rules if rule.strip()]
+
+
+class MetricNameFilter(object):
+    """
+    Drops or renames metrics by name before any context is built for them.
+
+    `allow` and `deny` are name prefixes, `deny_regex` a regular expression
+    matched from the start of the name and `rename` a list of
+    `old_prefix:new_prefix` rules, the longest matching prefix wins. Lists
+    may be given as comma separated strings, as in the configuration file.
+    Each set of rules is compiled into a single regex, and the outcome is
+    cached per name.
+    """
+
+    def __init__(self, allow=None, deny=None, deny_regex=None, rename=None,
+                 cache_size=CONTEXT_CACHE_SIZE_DEFAULT):
+        self.allow = self._compile_prefixes(_split_rules(allow))
+        self.deny = self._compile_prefixes(_split_rules(deny))
+        self.deny_regex = None
+        if deny_regex:
+            try:
+                self.deny_regex = re.compile(deny_regex)
+            except re.error, e:
+                log.warning("Ignoring the invalid metric deny regex %s: %s" % (deny_regex, e))
+
+        self.renames = {}
+        for rule in _split_rules(rename):
+            old_prefix, sep, new_prefix = rule.partition(':')
+            if not sep or not old_prefix:
+                log.warning("Ignoring the metric rename rule %s, expected old_prefix:new_prefix" % rule)
+                continue
+            self.renames[old_prefix] = new_prefix.strip()
+        self.rename = self._compile_prefixes(self.renames.keys())
+
+        # Resolved names by name, '' for a dropped one
+        self.cache = ContextCache(cache_size)
+
+    @staticmethod
+    def _compile_prefixes(prefixes):
+        if not prefixes:
+            return None
+        # Longest first, so that a match is the longest matching prefix
+        prefixes = sorted(prefixes, key=len, reverse=True)
+        return re.compile('|'.join(re.escape(prefix) for prefix in prefixes))
+
+    def is_active(self):
+        return bool(self.allow or self.deny or self.deny_regex or self.rename)
+
+    def resolve(self, name):
+        """ The name to submit the metric under, None to drop it. """
+        resolved = self.cache.get(name)
+        if resolved is None:
+            resolved = self._resolve(name)
+            self.cache.set(name, resolved)
+        return resolved or None
+
+    def _resolve(self, name):
+        if self.allow is not None and not self.allow.match(name):
+            return ''
+        if self.deny is not None and self.deny.match(name):
+            return ''
+        if self.deny_regex is not None and self.deny_regex.match(name):
+            return ''
+        if self.rename is not None:
+            match = self.rename.match(name)
+            if match is not None:
+                return self.renames[match.group()] + name[match.end():]
+        return name
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There is one instance per context (and per bucket for the bucket
+    aggregator), so metrics declare their attributes in `__slots__` instead of
+    carrying a `__dict__`. Name, tags, hostname and device name reference the
+    objects of the context, which are shared.
     """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time')
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
@@ -36,9 +214,28 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the points of another metric of the same context into this one. """
+        raise NotImplementedError()
+
+    def __getstate__(self):
+        # The formatter may be a closure that can't be pickled, the aggregator
+        # that receives the metric binds its own.
+        state = {}
+        for cls in type(self).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if slot != 'formatter' and hasattr(self, slot):
+                    state[slot] = getattr(self, slot)
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.iteritems():
+            setattr(self, slot, value)
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -55,6 +252,12 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Last write wins
+        if other.value is not None and other.last_sample_time >= self.last_sample_time:
+            self.value = other.value
+            self.timestamp = other.timestamp
+            self.last_sample_time = other.last_sample_time
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -80,6 +283,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -101,6 +305,7 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -133,6 +338,7 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -181,6 +387,7 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -195,6 +402,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -214,14 +425,27 @@ class Counter(Metric):
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
+# Typecode of the array holding the samples of a histogram by their type,
+# histograms with samples of several types keep them in a list
+HISTOGRAM_SAMPLE_TYPECODES = {int: 'l', float: 'd'}
+
+
 class Histogram(Metric):
-    """ A metric to track the distribution of a set of values. """
+    """
+    A metric to track the distribution of a set of values.
+
+    Samples all of the same type, int or float, are stored in an array. As
+    long as they are all ints the aggregates are computed with a partial
+    selection instead of a full sort. Other samples are kept as they are,
+    in a list, the aggregates are the same either way.
+    """
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
         self.count = 0
-        self.samples = []
+        self.samples = array('l')
         self.aggregates = extra_config['aggregates'] if\
             extra_config is not None and extra_config.get('aggregates') is not None\
             else DEFAULT_HISTOGRAM_AGGREGATES
@@ -235,20 +459,69 @@ class Histogram(Metric):
 
     def sample(self, value, sample_rate, timestamp=None):
         self.count += int(1 / sample_rate)
-        self.samples.append(value)
+        samples = self.samples
+        if samples.__class__ is array:
+            typecode = HISTOGRAM_SAMPLE_TYPECODES.get(value.__class__)
+            if typecode != samples.typecode:
+                if samples or typecode is None:
+                    samples = self.samples = samples.tolist()
+                else:
+                    samples = self.samples = array(typecode)
+        samples.append(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        samples, other_samples = self.samples, other.samples
+        if samples.__class__ is array and other_samples.__class__ is array and \
+                samples.typecode == other_samples.typecode:
+            samples.extend(other_samples)
+        elif not samples and other_samples.__class__ is array:
+            self.samples = array(other_samples.typecode, other_samples)
+        elif other_samples:
+            if samples.__class__ is array:
+                samples = self.samples = samples.tolist()
+            samples.extend(other_samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _summarize(self, ranks):
+        """ Returns the minimum, maximum and average of the samples and the
+        samples at the given ranks, in the order of the sorted samples. """
+        samples = self.samples
+        length = len(samples)
+        typecode = samples.typecode if samples.__class__ is array else None
+
+        if typecode == 'l' and numpy is not None:
+            # Integer sums are exact in any order, no need to sort
+            values = numpy.frombuffer(samples, dtype=numpy.dtype('l'))
+            selected = numpy.partition(values, sorted(set(ranks)))
+            min_, max_, total = int(values.min()), int(values.max()), sum(samples)
+            at_ranks = [int(selected[rank]) for rank in ranks]
+        else:
+            # Summed in ascending order, as they always were
+            if typecode == 'd' and numpy is not None and not numpy.isnan(numpy.frombuffer(samples)).any():
+                sorted_samples = numpy.sort(numpy.frombuffer(samples)).tolist()
+            else:
+                sorted_samples = sorted(samples)
+            min_, max_, total = sorted_samples[0], sorted_samples[-1], sum(sorted_samples)
+            at_ranks = [sorted_samples[rank] for rank in ranks]
+
+        return min_, max_, total / float(length), at_ranks
+
+    def _reset(self):
+        self.samples = array('l')
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
         length = len(self.samples)
-
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+        # Ranks of the median and of the percentiles. They were negative
+        # indexes of the sorted samples for a few edge cases, hence the modulo
+        ranks = [int(round(length/2 - 1)) % length]
+        ranks += [int(round(p * length - 1)) % length for p in self.percentiles]
+        min_, max_, avg, at_ranks = self._summarize(ranks)
+        med = at_ranks[0]
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -276,8 +549,7 @@ class Histogram(Metric):
             ) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, val in zip(self.percentiles, at_ranks[1:]):
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -290,14 +562,47 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
+        self._reset()
         self.count = 0
 
         return metrics
 
 
+class SketchHistogram(Histogram):
+    """
+    A histogram keeping a quantile sketch instead of every sample: memory
+    is bounded per context, and percentiles are exact within the relative
+    accuracy of the sketch. Minimum, maximum, average and count are exact.
+    """
+    __slots__ = ()
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(SketchHistogram, self).__init__(formatter, name, tags, hostname, device_name,
+                                              extra_config)
+        self.samples = QuantileSketch()
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.samples.add(value)
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.samples.merge(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _summarize(self, ranks):
+        sketch = self.samples
+        avg = sketch.sum / float(sketch.count)
+        return sketch.min, sketch.max, avg, [sketch.value_at_rank(rank) for rank in ranks]
+
+    def _reset(self):
+        self.samples = QuantileSketch()
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('values',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -312,6 +617,10 @@ class Set(Metric):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -330,8 +639,32 @@ class Set(Metric):
             self.values = set()
 
 
+class HyperLogLogSet(Set):
+    """
+    A set estimating its number of unique elements with a HyperLogLog, in
+    constant memory, instead of keeping them.
+    """
+    __slots__ = ()
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        super(HyperLogLogSet, self).__init__(formatter, name, tags, hostname, device_name,
+                                             extra_config)
+        self.values = HyperLogLog()
+
+    def merge(self, other):
+        self.values.merge(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, timestamp, interval):
+        try:
+            return super(HyperLogLogSet, self).flush(timestamp, interval)
+        finally:
+            self.values = HyperLogLog()
+
+
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -392,7 +725,8 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_sketch=False,
+            set_hyperloglog=False, top_k=None, name_filter=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -408,16 +742,46 @@ class Aggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Drop and rename rules of the metric names, see MetricNameFilter
+        self.name_filter = None
+        if name_filter is not None and name_filter.is_active():
+            self.name_filter = name_filter
+        self.num_filtered_points = 0
+
         # Additional config passed when instantiating metric configs
+        histogram_config = {
+            'aggregates': histogram_aggregates,
+            'percentiles': histogram_percentiles
+        }
         self.metric_config = {
-            Histogram: {
-                'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
-            }
+            Histogram: histogram_config,
+            SketchHistogram: histogram_config,
         }
+        # Keep quantile sketches instead of all the samples of histograms
+        self.histogram_class = SketchHistogram if histogram_sketch else Histogram
+        # Estimate the cardinality of sets instead of keeping their elements
+        self.set_class = HyperLogLogSet if set_hyperloglog else Set
 
         self.utf8_decoding = utf8_decoding
 
+        # Parsed metric lines, by line without the value
+        if context_cache_size is None:
+            context_cache_size = CONTEXT_CACHE_SIZE_DEFAULT
+        self.context_cache = None
+        if int(context_cache_size) > 0:
+            self.context_cache = ContextCache(context_cache_size)
+
+        self.tag_sets = TagSetTable()
+
+        # Metric names with the most packets and the most new contexts, when
+        # `top_k` is set
+        self.top_k = int(top_k or 0)
+        self.top_name_packets = None
+        self.top_name_contexts = None
+        if self.top_k:
+            self.top_name_packets = SpaceSaving(self.top_k)
+            self.top_name_contexts = SpaceSaving(self.top_k)
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -458,21 +822,7 @@ class Aggregator(object):
             # Submit the metric
             raw_value = value_and_metadata[0]
             metric_type = value_and_metadata[1]
-
-            if metric_type in self.ALLOW_STRINGS:
-                value = raw_value
-            else:
-                # Try to cast as an int first to avoid precision issues, then as a
-                # float.
-                try:
-                    value = int(raw_value)
-                except ValueError:
-                    try:
-                        value = float(raw_value)
-                    except ValueError:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
-
+            value = self._parse_metric_value(name, raw_value, metric_type)
 
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
@@ -489,6 +839,71 @@ class Aggregator(object):
 
         return parsed_packets
 
+    def _parse_metric_value(self, name, raw_value, metric_type):
+        if metric_type in self.ALLOW_STRINGS:
+            return raw_value
+        # Try to cast as an int first to avoid precision issues, then as a
+        # float.
+        try:
+            return int(raw_value)
+        except ValueError:
+            try:
+                return float(raw_value)
+            except ValueError:
+                # Otherwise, raise an error saying it must be a number
+                raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
+
+    def _submit_metric_packet(self, packet):
+        """
+        Parse and submit a metric packet. The line without its value is
+        looked up in the context cache first, so that a known metric skips
+        the parsing of its type, sample rate and tags and the building of
+        its context.
+        """
+        context_cache = self.context_cache
+        cache_key = None
+        if context_cache is not None:
+            name, _, value_and_metadata = packet.partition(':')
+            raw_value, _, metadata = value_and_metadata.partition('|')
+            # A name can't contain ':', so the key is unambiguous
+            cache_key = name + ':' + metadata
+            cached = context_cache.get(cache_key)
+            if cached is not None and ':' not in raw_value:
+                name, mtype, tags, hostname, device_name, sample_rate, context = cached
+                if self.top_name_packets is not None:
+                    self.top_name_packets.add(name)
+                value = self._parse_metric_value(name, raw_value, mtype)
+                self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                    device_name=device_name, sample_rate=sample_rate, context=context)
+                return
+
+        # Dropped names never make it to the context cache, nor get parsed
+        resolved_name = None
+        if self.name_filter is not None:
+            resolved_name = self.name_filter.resolve(packet.partition(':')[0])
+            if resolved_name is None:
+                self.num_filtered_points += 1
+                return
+
+        parsed_packets = self.parse_metric_packet(packet)
+        for name, value, mtype, tags, sample_rate in parsed_packets:
+            if resolved_name is not None:
+                name = resolved_name
+            if self.top_name_packets is not None:
+                self.top_name_packets.add(name)
+            hostname, device_name, tags = self._extract_magic_tags(tags)
+            # Keep hostname with empty string to unset it
+            if hostname is None:
+                hostname = self.hostname
+            context = self._build_context(name, tags, hostname, device_name)
+            self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                device_name=device_name, sample_rate=sample_rate, context=context)
+
+        # Packets holding several values aren't cached, their key doesn't
+        # describe them fully
+        if cache_key is not None and len(parsed_packets) == 1:
+            context_cache.set(cache_key, (name, mtype, tags, hostname, device_name, sample_rate, context))
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -596,12 +1011,7 @@ class Aggregator(object):
                 self.service_check(**service_check)
             else:
                 self.count += 1
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                        device_name=device_name, sample_rate=sample_rate)
-
+                self._submit_metric_packet(packet)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -625,9 +1035,50 @@ class Aggregator(object):
                 tags = tuple(tags) or None
         return hostname, device_name, tags
 
+    def _build_context(self, name, tags, hostname, device_name):
+        """ The key metrics are aggregated by. `hostname` must be resolved already. """
+        if tags is None:
+            return (name, tuple(), hostname, device_name)
+        return (name, self.tag_sets.intern(tuple(sorted(set(tags)))), hostname, device_name)
+
+    def _intern_context(self, context, tags):
+        """
+        Called when a metric is created for a new context, returns the context
+        and the metric tags with their tags interned.
+        """
+        tag_sets = self.tag_sets
+        context_tags = tag_sets.intern(context[1])
+        if isinstance(tags, tuple):
+            tags = tag_sets.intern(tags)
+        return (context[0], context_tags, context[2], context[3]), tags
+
+    def pop_top_names(self):
+        """
+        The metric names with the most packets and with the most new
+        contexts since the last call, as lists of (name, count), most
+        counted first. Counts may be overestimated, see SpaceSaving.
+        """
+        if not self.top_k:
+            return [], []
+        return self.top_name_packets.pop_top(), self.top_name_contexts.pop_top()
+
+    def live_contexts(self):
+        """ The contexts currently held by the aggregator. """
+        raise NotImplementedError()
+
+    def prune_tag_sets(self, live_count):
+        """ Drop the interned tags of the expired contexts once they make up
+        more than half of the table, and count the tags of the live ones. """
+        live_tag_sets = [context[1] for context in self.live_contexts()]
+        if len(self.tag_sets) > 2 * max(live_count, 1):
+            self.tag_sets.prune(live_tag_sets)
+        else:
+            self.tag_sets.count_references(live_tag_sets)
+
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                                device_name=None, timestamp=None, sample_rate=1):
-        """ Add a metric to be aggregated """
+                                device_name=None, timestamp=None, sample_rate=1, context=None):
+        """ Add a metric to be aggregated. `context` may be given when it's
+        already known, see `_build_context`. """
         raise NotImplementedError()
 
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
@@ -679,6 +1130,11 @@ class Aggregator(object):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
+    def iter_flush(self):
+        """ Same as `flush`, yielding the metrics as they're formatted
+        rather than returning their list. """
+        return iter(self.flush())
+
     def flush_events(self):
         events = self.events
         self.events = []
@@ -712,7 +1168,9 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_sketch=False,
+            set_hyperloglog=False, top_k=None, name_filter=None, max_contexts_per_name=None,
+            max_contexts=None, context_overflow=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -721,37 +1179,60 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_sketch,
+            set_hyperloglog,
+            top_k,
+            name_filter
         )
         self.metric_by_bucket = {}
+        # Counters keep reporting 0 until they expire. Their contexts are
+        # also kept in a heap by last sample time, to find the expired ones
+        # without a scan. Superseded heap entries are skipped when popped.
         self.last_sample_time_by_context = {}
+        self.counter_expiry_heap = []
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
         }
 
+        # Budgets of contexts per bucket, per metric name and overall. Points
+        # of new contexts past them go to an overflow context per name (or
+        # are dropped), and are counted by name in `context_overflows`.
+        self.max_contexts_per_name = int(max_contexts_per_name or 0)
+        self.max_contexts = int(max_contexts or 0)
+        self.limit_contexts = bool(self.max_contexts_per_name or self.max_contexts)
+        self.context_overflow = context_overflow or 'aggregate'
+        if self.context_overflow not in CONTEXT_OVERFLOW_POLICIES:
+            log.warning("Unknown context overflow policy %s, using 'aggregate'" % self.context_overflow)
+            self.context_overflow = 'aggregate'
+        self.context_count_by_bucket = {}
+        self.context_overflows = {}
+
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                                device_name=None, timestamp=None, sample_rate=1):
+                                device_name=None, timestamp=None, sample_rate=1, context=None):
         # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
+        # Note: if you change the way that context is created, please also change empty_metrics,
         #  which counts on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        if context is None:
+            if tags is None:
+                context = (name, tuple(), hostname, device_name)
+            else:
+                context = (name, tuple(sorted(set(tags))), hostname, device_name)
 
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
@@ -773,75 +1254,255 @@ class MetricsBucketAggregator(Aggregator):
                 self.current_mbc = metric_by_context
 
             if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+                if self.limit_contexts:
+                    context = self._check_context_budget(context, bucket_start_timestamp)
+                    if context is None:
+                        return
+                    if context[1] is OVERFLOW_TAGS:
+                        tags, hostname, device_name = OVERFLOW_TAGS, context[2], context[3]
+
+                if context not in metric_by_context:
+                    if self.top_name_contexts is not None:
+                        self.top_name_contexts.add(name)
+                    metric_class = self.metric_type_to_class[mtype]
+                    context, tags = self._intern_context(context, tags)
+                    metric_by_context[context] = metric_class(self.formatter, name, tags,
+                        hostname, device_name, self.metric_config.get(metric_class))
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+    def _check_context_budget(self, context, bucket_start_timestamp):
+        """
+        Called for a context new to its bucket. Returns the context to
+        aggregate the point in: the context itself, the overflow context of
+        its name when a budget is spent, or None to drop the point.
+        """
+        name = context[0]
+        # Contexts admitted in the bucket by name, and overall under None
+        counts = self.context_count_by_bucket.setdefault(bucket_start_timestamp, {})
+        count = counts.get(name, 0)
+        total = counts.get(None, 0)
+        if (self.max_contexts_per_name and count >= self.max_contexts_per_name) or \
+                (self.max_contexts and total >= self.max_contexts):
+            self.context_overflows[name] = self.context_overflows.get(name, 0) + 1
+            if self.context_overflow == 'drop':
+                return None
+            # Overflow contexts don't count against the budgets, there is at
+            # most one per name
+            return (name, OVERFLOW_TAGS, self.hostname, None)
+
+        counts[name] = count + 1
+        counts[None] = total + 1
+        return context
+
+    def pop_context_overflows(self):
+        """ Number of points over the context budgets by metric name, since
+        the last call. """
+        context_overflows, self.context_overflows = self.context_overflows, {}
+        return context_overflows
+
+    def export_state(self):
+        """
+        Hand over everything received since the last export, so that another
+        aggregator can merge it with `merge_state` (e.g. the partial aggregates
+        of a dogstatsd worker process). The returned state is picklable.
+        """
+        state = {
+            'metric_by_bucket': self.metric_by_bucket,
+            'events': self.events,
+            'service_checks': self.service_checks,
+            'count': self.count,
+            'event_count': self.event_count,
+            'service_check_count': self.service_check_count,
+            'num_discarded_old_points': self.num_discarded_old_points,
+            'num_filtered_points': self.num_filtered_points,
+            'context_overflows': self.context_overflows,
+            'top_name_packets': self.top_name_packets,
+            'top_name_contexts': self.top_name_contexts,
+        }
+        self.metric_by_bucket = {}
+        self.context_count_by_bucket = {}
+        self.context_overflows = {}
+        if self.top_k:
+            self.top_name_packets = SpaceSaving(self.top_k)
+            self.top_name_contexts = SpaceSaving(self.top_k)
+        self.current_bucket = None
+        self.current_mbc = {}
+        self.events = []
+        self.service_checks = []
+        self.count = 0
+        self.event_count = 0
+        self.service_check_count = 0
+        self.num_discarded_old_points = 0
+        self.num_filtered_points = 0
+        # The receiving aggregator interns the tags of the exported contexts
+        self.prune_tag_sets(0)
+        return state
+
+    def merge_state(self, state):
+        """ Merge a state returned by `export_state` into this aggregator.
+        The contexts new to their bucket are subject to the context budgets,
+        a bucket may be spread over several exports. """
+        for bucket_start_timestamp, metrics in state['metric_by_bucket'].iteritems():
+            metric_by_context = self.metric_by_bucket.setdefault(bucket_start_timestamp, {})
+            for context, metric in metrics.iteritems():
+                existing = metric_by_context.get(context)
+                if existing is None and self.limit_contexts and context[1] != OVERFLOW_TAGS:
+                    context = self._check_context_budget(context, bucket_start_timestamp)
+                    if context is None:
+                        continue
+                    if context[1] is OVERFLOW_TAGS:
+                        metric.tags, metric.hostname, metric.device_name = OVERFLOW_TAGS, context[2], context[3]
+                        existing = metric_by_context.get(context)
+                if existing is not None:
+                    # The type of a context may change between two exports
+                    if existing.__class__ is not metric.__class__:
+                        log.warning("Not merging %s %s points into a %s of the same context" %
+                                    (metric.__class__.__name__, context[0], existing.__class__.__name__))
+                        continue
+                    existing.merge(metric)
+                else:
+                    metric.formatter = self.formatter
+                    context, metric.tags = self._intern_context(context, metric.tags)
+                    metric_by_context[context] = metric
+
+        self.events.extend(state['events'])
+        self.service_checks.extend(state['service_checks'])
+        self.count += state['count']
+        self.event_count += state['event_count']
+        self.service_check_count += state['service_check_count']
+        self.num_discarded_old_points += state['num_discarded_old_points']
+        self.num_filtered_points += state['num_filtered_points']
+        for name, count in state['context_overflows'].iteritems():
+            self.context_overflows[name] = self.context_overflows.get(name, 0) + count
+        if self.top_k and state['top_name_packets'] is not None:
+            self.top_name_packets.merge(state['top_name_packets'])
+            self.top_name_contexts.merge(state['top_name_contexts'])
+
+    def live_contexts(self):
+        live_contexts = set(self.last_sample_time_by_context)
+        for metric_by_context in self.metric_by_bucket.itervalues():
+            live_contexts.update(metric_by_context)
+        return live_contexts
+
+    def _track_counter(self, context, last_sample_time):
+        if self.last_sample_time_by_context.get(context) != last_sample_time:
+            self.last_sample_time_by_context[context] = last_sample_time
+            heapq.heappush(self.counter_expiry_heap, (last_sample_time, context))
+
+    def _expire_counters(self, expiry_timestamp):
+        heap = self.counter_expiry_heap
+        last_sample_time_by_context = self.last_sample_time_by_context
+        while heap and heap[0][0] < expiry_timestamp:
+            last_sample_time, context = heapq.heappop(heap)
+            if last_sample_time_by_context.get(context) == last_sample_time:
+                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                del last_sample_time_by_context[context]
+
+        # Drop the superseded entries once they make up most of the heap
+        if len(heap) > 2 * len(last_sample_time_by_context) + 1024:
+            self.counter_expiry_heap = [(t, c) for c, t in last_sample_time_by_context.iteritems()]
+            heapq.heapify(self.counter_expiry_heap)
+
+    def empty_metrics(self, contexts, metric_by_context, flush_timestamp):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+        # This counts on the ordering of the context created in submit_metric not changing
+        formatter = self.formatter
+        interval = self.interval
+        # As flushed by a Counter without samples
+        value = 0 / interval
+        last_sample_time_by_context = self.last_sample_time_by_context
+        for context in contexts:
+            if context in last_sample_time_by_context and \
+                    not isinstance(metric_by_context.get(context), Counter):
+                yield formatter(
+                    metric=context[0],
+                    value=value,
+                    timestamp=flush_timestamp,
+                    tags=context[1],
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.RATE,
+                    interval=interval,
+                )
 
     def flush(self):
+        return list(self.iter_flush())
+
+    def iter_flush(self):
+        """ Same as `flush`, yielding the metrics as they're formatted. The
+        buckets to flush are taken out first, points can keep being
+        submitted while the metrics are consumed. """
         cur_time = time()
         flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
 
-        metrics = []
+        self._expire_counters(expiry_timestamp)
 
         if self.metric_by_bucket:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
+            #  re-create non-expired metrics.
+            buckets = []
             for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
                 if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
+                    buckets.append((bucket_start_timestamp, self.metric_by_bucket.pop(bucket_start_timestamp)))
+                    self.context_count_by_bucket.pop(bucket_start_timestamp, None)
+        else:
+            buckets = None
+        self.current_bucket = None
+        self.current_mbc = {}
+
+        # The tracked counters, taken once as points keep being submitted
+        # while the metrics are consumed. The counters tracked during the
+        # flush are added as they come.
+        counter_contexts = list(self.last_sample_time_by_context)
+        try:
+            if buckets is not None:
+                for bucket_start_timestamp, metric_by_context in buckets:
+                    for context, metric in metric_by_context.iteritems():
                         if metric.last_sample_time < expiry_timestamp:
                             # This should never happen
                             log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
                             self.last_sample_time_by_context.pop(context, None)
                         else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
+                            for formatted in metric.flush(bucket_start_timestamp, self.interval):
+                                yield formatted
                             if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
+                                if context not in self.last_sample_time_by_context:
+                                    counter_contexts.append(context)
+                                self._track_counter(context, metric.last_sample_time)
                     # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
-        else:
-            # Even if there are no metrics in this flush, there may be some non-expired counters
-            #  We should only create these non-expired metrics if we've passed an interval since the last flush
-            if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp, \
-                                                flush_cutoff_time-self.interval, metrics)
+                    for formatted in self.empty_metrics(counter_contexts, metric_by_context, bucket_start_timestamp):
+                        yield formatted
+            else:
+                # Even if there are no metrics in this flush, there may be some non-expired counters
+                #  We should only create these non-expired metrics if we've passed an interval since the last flush
+                if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
+                    for formatted in self.empty_metrics(counter_contexts, {}, flush_cutoff_time - self.interval):
+                        yield formatted
+        finally:
+            self._end_flush(flush_cutoff_time)
 
+    def _end_flush(self, flush_cutoff_time):
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_filtered_points > 0:
+            log.debug('%s points were dropped by the metric name rules' % self.num_filtered_points)
+            self.num_filtered_points = 0
+
+        # Counters may also be in the remaining buckets, the count is an upper bound
+        self.prune_tag_sets(len(self.last_sample_time_by_context) +
+                            sum(len(m) for m in self.metric_by_bucket.itervalues()))
+
         # Save some stats.
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
         self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
-        return metrics
 
 
 class MetricsAggregator(Aggregator):
@@ -852,7 +1513,8 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_sketch=False,
+            set_hyperloglog=False, top_k=None, name_filter=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -861,7 +1523,12 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            histogram_sketch,
+            set_hyperloglog,
+            top_k,
+            name_filter
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -869,25 +1536,29 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
+            's': self.set_class,
             '_dd-r': Rate,
         }
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                                device_name=None, timestamp=None, sample_rate=1):
+                                device_name=None, timestamp=None, sample_rate=1, context=None):
         # Avoid calling extra functions to dedupe tags if there are none
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        if context is None:
+            if tags is None:
+                context = (name, tuple(), hostname, device_name)
+            else:
+                context = (name, tuple(sorted(set(tags))), hostname, device_name)
         if context not in self.metrics:
+            if self.top_name_contexts is not None:
+                self.top_name_contexts.add(name)
             metric_class = self.metric_type_to_class[mtype]
+            context, tags = self._intern_context(context, tags)
             self.metrics[context] = metric_class(self.formatter, name, tags,
                 hostname, device_name, self.metric_config.get(metric_class))
         cur_time = time()
@@ -897,6 +1568,9 @@ class MetricsAggregator(Aggregator):
         else:
             self.metrics[context].sample(value, sample_rate, timestamp)
 
+    def live_contexts(self):
+        return self.metrics.keys()
+
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
 
@@ -937,11 +1611,17 @@ class MetricsAggregator(Aggregator):
             else:
                 metrics += metric.flush(timestamp, self.interval)
 
+        self.prune_tag_sets(len(self.metrics))
+
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_filtered_points > 0:
+            log.debug('%s points were dropped by the metric name rules' % self.num_filtered_points)
+            self.num_filtered_points = 0
+
         # Save some stats.
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
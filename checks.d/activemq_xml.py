@@ -1,9 +1,6 @@
 # stdlib
 from xml.etree import ElementTree
 
-# third party
-import requests
-
 # project
 from checks import AgentCheck
 
@@ -29,9 +26,6 @@ SUBSCRIBER_TAGS = [
 MAX_ELEMENTS = 300
 
 class ActiveMQXML(AgentCheck):
-    # do this so we can mock out requests in unit tests
-    requests = requests
-
     def check(self, instance):
         url = instance.get("url")
         username = instance.get("username")
@@ -62,7 +56,7 @@ class ActiveMQXML(AgentCheck):
             auth = (username, password)
         url = "%s%s" % (base_url, xml_url)
         self.log.debug("ActiveMQ Fetching queue data from: %s" % url)
-        r = self.requests.get(url, auth=auth)
+        r = self.http.get(url, auth=auth)
         r.raise_for_status()
         return r.text
 
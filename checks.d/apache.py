@@ -5,8 +5,6 @@ import urlparse
 from util import headers
 from checks import AgentCheck
 
-# 3rd party
-import requests
 
 class Apache(AgentCheck):
     """Tracks basic connection/requests/workers metrics
@@ -50,7 +48,7 @@ class Apache(AgentCheck):
         service_check_name = 'apache.can_connect'
         service_check_tags = ['host:%s' % apache_host, 'port:%s' % apache_port]
         try:
-            r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+            r = self.http.get(url, auth=auth, headers=headers(self.agentConfig))
             r.raise_for_status()
 
         except Exception:
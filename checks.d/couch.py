@@ -43,7 +43,7 @@ class CouchDb(AgentCheck):
         if 'user' in instance and 'password' in instance:
             auth = (instance['user'], instance['password'])
 
-        r = requests.get(url, auth=auth, headers=headers(self.agentConfig),
+        r = self.http.get(url, auth=auth, headers=headers(self.agentConfig),
                          timeout=int(instance.get('timeout', self.TIMEOUT)))
         r.raise_for_status()
         return r.json()
@@ -54,7 +54,7 @@ class Couchbase(AgentCheck):
         if 'user' in instance and 'password' in instance:
             auth = (instance['user'], instance['password'])
 
-        r = requests.get(url, auth=auth, headers=headers(self.agentConfig),
+        r = self.http.get(url, auth=auth, headers=headers(self.agentConfig),
             timeout=timeout)
         r.raise_for_status()
         return r.json()
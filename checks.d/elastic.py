@@ -5,9 +5,6 @@ import subprocess
 import time
 import urlparse
 
-# 3p
-import requests
-
 # project
 from checks import AgentCheck
 from config import _is_affirmative
@@ -301,7 +298,7 @@ class ESCheck(AgentCheck):
             auth = None
 
         try:
-            resp = requests.get(
+            resp = self.http.get(
                 url,
                 timeout=config.timeout,
                 headers=headers(self.agentConfig),
@@ -102,7 +102,7 @@ class Etcd(AgentCheck):
 
     def get_json(self, url, timeout):
         try:
-            r = requests.get(url, timeout=timeout, headers=headers(self.agentConfig))
+            r = self.http.get(url, timeout=timeout, headers=headers(self.agentConfig))
         except requests.exceptions.Timeout as e:
             # If there's a timeout
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
@@ -8,7 +8,6 @@ from checks import AgentCheck
 
 # 3rd party
 import simplejson as json
-import requests
 
 class Fluentd(AgentCheck):
     SERVICE_CHECK_NAME = 'fluentd.is_ok'
@@ -35,7 +34,7 @@ class Fluentd(AgentCheck):
             monitor_agent_port = parsed_url.port or 24220
             service_check_tags = ['fluentd_host:%s' % monitor_agent_host, 'fluentd_port:%s' % monitor_agent_port]
 
-            r = requests.get(url, headers=headers(self.agentConfig))
+            r = self.http.get(url, headers=headers(self.agentConfig))
             r.raise_for_status()
             status = r.json()
 
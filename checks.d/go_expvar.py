@@ -5,8 +5,6 @@ from collections import defaultdict
 # project
 from checks import AgentCheck
 
-# 3rd party
-import requests
 
 DEFAULT_MAX_METRICS = 350
 PATH = "path"
@@ -57,7 +55,7 @@ class GoExpvar(AgentCheck):
         self._last_gc_count = defaultdict(int)
 
     def _get_data(self, url):
-        r = requests.get(url)
+        r = self.http.get(url)
         r.raise_for_status()
         return r.json()
 
@@ -8,8 +8,6 @@ from checks import AgentCheck
 from config import _is_affirmative
 from util import headers
 
-# 3rd party
-import requests
 
 STATS_URL = "/;csv;norefresh"
 EVENT_TYPE = SOURCE_TYPE_NAME = 'haproxy'
@@ -110,7 +108,7 @@ class HAProxy(AgentCheck):
 
         self.log.debug("HAProxy Fetching haproxy search data from: %s" % url)
 
-        r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+        r = self.http.get(url, auth=auth, headers=headers(self.agentConfig))
         r.raise_for_status()
 
         return r.content.splitlines()
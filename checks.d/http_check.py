@@ -82,6 +82,8 @@ class HTTPCheck(NetworkCheck):
             if username is not None and password is not None:
                 auth = (username, password)
 
+            # A new connection for each run: the response time includes the
+            # connection and a failure to connect is reported
             r = requests.get(addr, auth=auth, timeout=timeout, headers=headers,
                              verify=not disable_ssl_validation)
 
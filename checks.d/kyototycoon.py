@@ -65,7 +65,7 @@ class KyotoTycoonCheck(AgentCheck):
 
 
         try:
-            r = requests.get(url)
+            r = self.http.get(url)
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
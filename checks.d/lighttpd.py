@@ -6,8 +6,6 @@ import re
 from util import headers
 from checks import AgentCheck
 
-# 3rd party
-import requests
 
 VERSION_REGEX = re.compile(r".*/(\d)")
 
@@ -89,7 +87,7 @@ class Lighttpd(AgentCheck):
         lighttpd_port = parsed_url.port or 80
         service_check_tags = ['host:%s' % lighttpd_url, 'port:%s' % lighttpd_port]
         try:
-            r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+            r = self.http.get(url, auth=auth, headers=headers(self.agentConfig))
             r.raise_for_status()
         except Exception:
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL,
@@ -57,7 +57,7 @@ class Marathon(AgentCheck):
 
     def get_json(self, url, timeout, auth):
         try:
-            r = requests.get(url, timeout=timeout, auth=auth)
+            r = self.http.get(url, timeout=timeout, auth=auth)
             r.raise_for_status()
         except requests.exceptions.Timeout:
             # If there's a timeout
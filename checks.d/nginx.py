@@ -62,7 +62,7 @@ class Nginx(AgentCheck):
         service_check_name = 'nginx.can_connect'
         service_check_tags = ['host:%s' % nginx_host, 'port:%s' % nginx_port]
         try:
-            r = requests.get(url, auth=auth, headers=headers(self.agentConfig))
+            r = self.http.get(url, auth=auth, headers=headers(self.agentConfig))
             r.raise_for_status()
         except Exception:
             self.service_check(service_check_name, AgentCheck.CRITICAL,
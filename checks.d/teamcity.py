@@ -30,7 +30,7 @@ class TeamCityCheck(AgentCheck):
             build_conf=build_conf
         )
         try:
-            resp = requests.get(build_url, timeout=self.DEFAULT_TIMEOUT, headers=self.HEADERS)
+            resp = self.http.get(build_url, timeout=self.DEFAULT_TIMEOUT, headers=self.HEADERS)
             resp.raise_for_status()
 
             last_build_id = resp.json().get('build')[0].get('id')
@@ -111,7 +111,7 @@ class TeamCityCheck(AgentCheck):
         )
 
         try:
-            resp = requests.get(new_build_url, timeout=self.DEFAULT_TIMEOUT, headers=self.HEADERS)
+            resp = self.http.get(new_build_url, timeout=self.DEFAULT_TIMEOUT, headers=self.HEADERS)
             resp.raise_for_status()
 
             new_builds = resp.json()
@@ -16,7 +16,7 @@ import copy
 from pprint import pprint
 from collections import defaultdict
 
-from util import LaconicFilter, get_os, get_hostname, get_next_id, yLoader
+from util import LaconicFilter, get_os, get_hostname, get_next_id, get_http_sessions, yLoader
 from config import get_confd_path
 from checks import check_status
 
@@ -303,6 +303,9 @@ class AgentCheck(object):
         self.warnings = []
         self.library_versions = None
         self.last_collection_time = defaultdict(int)
+        # Keep-alive HTTP sessions shared by all the checks, use
+        # `self.http.get(...)` as `requests.get(...)`
+        self.http = get_http_sessions()
 
     def instance_count(self):
         """ Return the number of instances that are configured for this check. """
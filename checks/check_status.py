@@ -580,13 +580,28 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-        metric_count=0, event_count=0):
+        metric_count=0, event_count=0, datagrams_per_wakeup=0, socket_path=None,
+        ring_slots=None, ring_high_water=None, ring_overflow=None,
+        top_metric_names=None, top_metric_contexts=None, top_sources=None,
+        sender_queued=None, sender_spilled=None, sender_dropped=None, http_stats=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
         self.packets_per_second = packets_per_second
         self.metric_count = metric_count
         self.event_count = event_count
+        self.datagrams_per_wakeup = datagrams_per_wakeup
+        self.socket_path = socket_path
+        self.ring_slots = ring_slots
+        self.ring_high_water = ring_high_water
+        self.ring_overflow = ring_overflow
+        self.top_metric_names = top_metric_names or []
+        self.top_metric_contexts = top_metric_contexts or []
+        self.top_sources = top_sources or []
+        self.sender_queued = sender_queued
+        self.sender_spilled = sender_spilled
+        self.sender_dropped = sender_dropped
+        self.http_stats = http_stats or {}
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -598,7 +613,28 @@ class DogstatsdStatus(AgentStatus):
             "Packets per second: %s" % self.packets_per_second,
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
+            "Datagrams per wakeup: %s" % self.datagrams_per_wakeup,
         ]
+        if self.socket_path:
+            lines.append("Unix socket: %s" % self.socket_path)
+        if self.ring_slots:
+            lines += [
+                "Receive ring occupancy (max): %s/%s" % (self.ring_high_water, self.ring_slots),
+                "Receive ring overflows: %s" % self.ring_overflow,
+            ]
+        if self.sender_queued is not None:
+            lines += [
+                "Payloads waiting to be sent: %s (%s on disk)" % (self.sender_queued + self.sender_spilled, self.sender_spilled),
+                "Payloads dropped: %s" % self.sender_dropped,
+            ]
+        if self.http_stats.get('requests'):
+            lines.append("HTTP requests: %s (%s over a reused connection)"
+                         % (self.http_stats['requests'], self.http_stats['reused']))
+        for title, top in [("Top metrics by packets", self.top_metric_names),
+                           ("Top metrics by new contexts", self.top_metric_contexts),
+                           ("Top senders by datagrams", self.top_sources)]:
+            if top:
+                lines.append("%s: %s" % (title, ', '.join("%s (%s)" % item for item in top[:5])))
         return lines
 
     def to_dict(self):
@@ -609,6 +645,18 @@ class DogstatsdStatus(AgentStatus):
             'packets_per_second': self.packets_per_second,
             'metric_count': self.metric_count,
             'event_count': self.event_count,
+            'datagrams_per_wakeup': self.datagrams_per_wakeup,
+            'socket_path': self.socket_path,
+            'ring_slots': self.ring_slots,
+            'ring_high_water': self.ring_high_water,
+            'ring_overflow': self.ring_overflow,
+            'top_metric_names': self.top_metric_names,
+            'top_metric_contexts': self.top_metric_contexts,
+            'top_sources': self.top_sources,
+            'sender_queued': self.sender_queued,
+            'sender_spilled': self.sender_spilled,
+            'sender_dropped': self.sender_dropped,
+            'http_stats': self.http_stats,
         })
         return status_info
 
@@ -618,13 +666,20 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-            transactions_flushed=0):
+            transactions_flushed=0, transactions_in_flight=0, drain_rate=0, queue_disk_size=0,
+            queue_memory_size=0, queue_size_by_type=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
+        self.queue_disk_size = queue_disk_size
+        self.queue_memory_size = queue_memory_size
+        # (count, size) by transaction type
+        self.queue_size_by_type = queue_size_by_type or {}
         self.flush_count = flush_count
         self.transactions_received = transactions_received
         self.transactions_flushed = transactions_flushed
+        self.transactions_in_flight = transactions_in_flight
+        self.drain_rate = drain_rate
         self.proxy_data = get_config(parse_args=False).get('proxy_settings')
         self.hidden_username = None
         self.hidden_password = None
@@ -638,12 +693,22 @@ class ForwarderStatus(AgentStatus):
         lines = [
             "Queue Size: %s bytes" % self.queue_size,
             "Queue Length: %s" % self.queue_length,
+            "Queue Size in Memory: %s bytes" % self.queue_memory_size,
+            "Queue Size on Disk: %s bytes" % self.queue_disk_size,
             "Flush Count: %s" % self.flush_count,
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
+            "Transactions in flight: %s" % self.transactions_in_flight,
+            "Transactions flushed per second: %s" % self.drain_rate,
             ""
         ]
 
+        if self.queue_size_by_type:
+            lines += ["Queue by type", "============="]
+            for tr_type, (count, size) in sorted(self.queue_size_by_type.iteritems()):
+                lines.append("  %s: %s transaction(s), %s bytes" % (tr_type, count, size))
+            lines.append("")
+
         if self.proxy_data:
             lines += [
                 "Proxy",
@@ -669,6 +734,11 @@ class ForwarderStatus(AgentStatus):
             'flush_count': self.flush_count,
             'queue_length': self.queue_length,
             'queue_size': self.queue_size,
+            'queue_disk_size': self.queue_disk_size,
+            'queue_memory_size': self.queue_memory_size,
+            'queue_size_by_type': self.queue_size_by_type,
+            'transactions_in_flight': self.transactions_in_flight,
+            'drain_rate': self.drain_rate,
             'proxy_data': self.proxy_data,
             'hidden_username': self.hidden_username,
             'hidden_password': self.hidden_password,
@@ -514,6 +514,18 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option("Main", "utf8_decoding"):
             agentConfig["utf8_decoding"] = _is_affirmative(config.get("Main", "utf8_decoding"))
 
+        agentConfig["histogram_sketch"] = False
+        if config.has_option("Main", "histogram_sketch"):
+            agentConfig["histogram_sketch"] = _is_affirmative(config.get("Main", "histogram_sketch"))
+
+        agentConfig["set_hyperloglog"] = False
+        if config.has_option("Main", "set_hyperloglog"):
+            agentConfig["set_hyperloglog"] = _is_affirmative(config.get("Main", "set_hyperloglog"))
+
+        agentConfig["dogstatsd_top_k_metrics"] = False
+        if config.has_option("Main", "dogstatsd_top_k_metrics"):
+            agentConfig["dogstatsd_top_k_metrics"] = _is_affirmative(config.get("Main", "dogstatsd_top_k_metrics"))
+
     except ConfigParser.NoSectionError, e:
         sys.stderr.write('Config file not found or incorrectly formatted.\n')
         sys.exit(2)
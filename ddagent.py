@@ -21,12 +21,14 @@ from datetime import timedelta
 import logging
 from Queue import Full, Queue
 from socket import gaierror, error as socket_error
+from functools import partial
 import sys
 import threading
 import zlib
 
 # Tornado
 from tornado.escape import json_decode
+import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
 from tornado.options import define, parse_command_line, options
@@ -41,6 +43,7 @@ from config import (
 )
 from util import Watchdog, get_uuid, get_hostname, json, get_tornado_ioloop
 from transaction import Transaction, TransactionManager
+from utils.segment_store import SegmentStore
 import modules
 
 # 3rd party
@@ -69,7 +72,21 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
-THROTTLING_DELAY = timedelta(microseconds=1000000/2)  # 2 msg/second
+# Transactions are sent at most at this average rate, in bursts of up to
+# MAX_BURST transactions
+THROTTLING_DELAY = timedelta(microseconds=1000000/10)  # 10 msg/second
+MAX_BURST = 10
+
+# Maximum number of requests waiting for a response at once, a batch of
+# transactions being one request
+MAX_IN_FLIGHT = 4
+
+# Maximum size of the uncompressed payload of transactions sent in one
+# request, merged on the IOLoop
+MAX_BATCH_SIZE = 2 * 1024 * 1024  # 2MB
+
+# Disk budget of the transactions queue, when kept on disk
+MAX_QUEUE_DISK_SIZE = 1024 * 1024 * 1024  # 1GB
 
 
 class EmitterThread(threading.Thread):
@@ -139,14 +156,28 @@ class AgentTransaction(Transaction):
     _application = None
     _trManager = None
     _endpoints = []
+    _endpoint_urls = {}
     _emitter_manager = None
+    _http_client = None
     _type = None
 
     @classmethod
     def set_application(cls, app):
         cls._application = app
+        AgentTransaction._endpoint_urls = {}
         cls._emitter_manager = EmitterManager(cls._application._agentConfig)
 
+    # Shared by all the transaction types
+    @staticmethod
+    def set_http_client(client):
+        AgentTransaction._http_client = client
+
+    @staticmethod
+    def get_http_client():
+        if AgentTransaction._http_client is None:
+            AgentTransaction._http_client = tornado.httpclient.AsyncHTTPClient()
+        return AgentTransaction._http_client
+
     @classmethod
     def set_tr_manager(cls, manager):
         cls._trManager = manager
@@ -173,6 +204,8 @@ class AgentTransaction(Transaction):
 
     def __init__(self, data, headers):
         self._data = data
+        self._data_size = None
+        self._batch_size = None
         self._headers = headers
         self._headers['DD-Forwarder-Version'] = get_version()
 
@@ -188,65 +221,125 @@ class AgentTransaction(Transaction):
         log.debug("Created transaction %d" % self.get_id())
         self._trManager.flush()
 
+    @classmethod
+    def from_record(cls, record):
+        """ Build back a transaction written by `serialize`. It isn't queued. """
+        meta, data = record.split('\n', 1)
+        meta = json.loads(meta)
+        tr_class = TRANSACTION_TYPES.get(meta['type'])
+        if tr_class is None:
+            log.warning("Unknown transaction type %s in the disk queue" % meta['type'])
+            return None
+        tr = tr_class.__new__(tr_class)
+        tr._data = data
+        tr._data_size = None
+        tr._batch_size = None
+        tr._headers = dict((str(k), str(v)) for k, v in meta['headers'].iteritems())
+        Transaction.__init__(tr)
+        return tr
+
+    def serialize(self):
+        meta = {'type': self.__class__.__name__, 'headers': dict(self._headers)}
+        return json.dumps(meta) + '\n' + self._data
+
+    def has_data(self):
+        return self._data is not None
+
+    def drop_data(self):
+        self._data = None
+
+    def load_data(self, record):
+        self._data = record.split('\n', 1)[1]
+
+    def get_data_size(self):
+        if self._data_size is None:
+            self._data_size = sys.getsizeof(self._data)
+        return self._data_size
+
+    def get_batch_size(self):
+        # Uncompressed, as decoded and encoded again by `flush_batch`
+        if self._batch_size is None:
+            data = self._data
+            if self._headers.get('Content-Encoding') == 'deflate':
+                try:
+                    data = zlib.decompress(data)
+                except zlib.error:
+                    pass
+            self._batch_size = len(data)
+        return self._batch_size
+
     def __sizeof__(self):
-        return sys.getsizeof(self._data)
+        # The payload, the headers and the transaction itself
+        headers = self._headers
+        return object.__sizeof__(self) + sys.getsizeof(self.__dict__) \
+            + self.get_data_size() + sys.getsizeof(headers) \
+            + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in headers.iteritems())
+
+    def get_endpoint_url(self, endpoint):
+        """ `get_url`, computed once by transaction type. """
+        key = (self.__class__, endpoint)
+        url = self._endpoint_urls.get(key)
+        if url is None:
+            url = AgentTransaction._endpoint_urls[key] = self.get_url(endpoint)
+        return url
+
+    def get_batch_items(self):
+        """ The items of the payload, to be merged with other transactions
+        of the same type by `make_batch_payload`, or None. """
+        return None
+
+    def make_batch_payload(self, items):
+        raise NotImplementedError("To be implemented in a subclass")
+
+    def decode_data(self):
+        data = self._data
+        if self._headers.get('Content-Encoding') == 'deflate':
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+    def flush_batch(self, batch):
+        items = []
+        merged = []
+        for tr in batch:
+            try:
+                tr_items = tr.get_batch_items()
+            except Exception:
+                log.warning("Unable to decode transaction %s, sending it on its own" % tr.get_id())
+                tr_items = None
+            if tr_items is None:
+                tr.flush()
+            else:
+                items.extend(tr_items)
+                merged.append(tr)
+
+        if len(merged) == 1:
+            merged[0].flush()
+        elif merged:
+            # Compressed once for the whole batch
+            data = zlib.compress(json.dumps(self.make_batch_payload(items)))
+            headers = dict(self._headers)
+            headers['Content-Type'] = 'application/json'
+            headers['Content-Encoding'] = 'deflate'
+            self._post(data, headers, partial(self.on_batch_response, merged))
 
     def flush(self):
+        self._post(self._data, self._headers, self.on_response)
+
+    def _post(self, data, headers, callback):
+        # Remove headers that were passed by the emitter. Those don't apply anymore
+        # This is pretty hacky though as it should be done in pycurl or curl or tornado
+        for h in HEADERS_TO_REMOVE:
+            if h in headers:
+                del headers[h]
+                log.debug("Removing {0} header.".format(h))
+
+        # The client fills in the settings shared by all the requests
+        http = self.get_http_client()
         for endpoint in self._endpoints:
-            url = self.get_url(endpoint)
+            url = self.get_endpoint_url(endpoint)
             log.debug("Sending %s to endpoint %s at %s" % (self._type, endpoint, url))
-
-            # Getting proxy settings
-            proxy_settings = self._application._agentConfig.get('proxy_settings', None)
-
-            tornado_client_params = {
-                'url': url,
-                'method': 'POST',
-                'body': self._data,
-                'headers': self._headers,
-                'validate_cert': not self._application.skip_ssl_validation,
-            }
-
-            # Remove headers that were passed by the emitter. Those don't apply anymore
-            # This is pretty hacky though as it should be done in pycurl or curl or tornado
-            for h in HEADERS_TO_REMOVE:
-                if h in tornado_client_params['headers']:
-                    del tornado_client_params['headers'][h]
-                    log.debug("Removing {0} header.".format(h))
-
-            force_use_curl = False
-
-            if proxy_settings is not None:
-                force_use_curl = True
-                if pycurl is not None:
-                    log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
-                              proxy_settings['host'], proxy_settings['port']))
-                    tornado_client_params['proxy_host'] = proxy_settings['host']
-                    tornado_client_params['proxy_port'] = proxy_settings['port']
-                    tornado_client_params['proxy_username'] = proxy_settings['user']
-                    tornado_client_params['proxy_password'] = proxy_settings['password']
-
-                    if self._application._agentConfig.get('proxy_forbid_method_switch'):
-                        # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
-                        tornado_client_params['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
-
-            if (not self._application.use_simple_http_client or force_use_curl) and pycurl is not None:
-                ssl_certificate = self._application._agentConfig.get('ssl_certificate', None)
-                tornado_client_params['ca_certs'] = ssl_certificate
-
-            req = tornado.httpclient.HTTPRequest(**tornado_client_params)
-            use_curl = force_use_curl or self._application._agentConfig.get("use_curl_http_client") and not self._application.use_simple_http_client
-
-            if use_curl:
-                if pycurl is None:
-                    log.error("dd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
-                else:
-                    log.debug("Using CurlAsyncHTTPClient")
-                    tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-            else:
-                log.debug("Using SimpleHTTPClient")
-            http = tornado.httpclient.AsyncHTTPClient()
-            http.fetch(req, callback=self.on_response)
+            req = tornado.httpclient.HTTPRequest(url, method='POST', body=data, headers=headers)
+            http.fetch(req, callback=callback)
 
     def on_response(self, response):
         if response.error:
@@ -257,6 +350,17 @@ class AgentTransaction(Transaction):
 
         self._trManager.flush_next()
 
+    def on_batch_response(self, batch, response):
+        if response.error:
+            log.error("Response: %s" % response)
+            for tr in batch:
+                self._trManager.tr_error(tr)
+        else:
+            for tr in batch:
+                self._trManager.tr_success(tr)
+
+        self._trManager.flush_next()
+
 
 class MetricTransaction(AgentTransaction):
     _type = "metrics"
@@ -278,6 +382,18 @@ class APIMetricTransaction(MetricTransaction):
         url = endpoint_base_url + '/api/v1/series/?api_key=' + api_key
         return url
 
+    def get_coalesce_key(self):
+        return self.__class__.__name__
+
+    def get_batch_items(self):
+        payload = self.decode_data()
+        if isinstance(payload, dict) and payload.keys() == ['series']:
+            return payload['series']
+        return None
+
+    def make_batch_payload(self, items):
+        return {'series': items}
+
     def get_data(self):
         return self._data
 
@@ -292,6 +408,23 @@ class APIServiceCheckTransaction(AgentTransaction):
         url = endpoint_base_url + '/api/v1/check_run/?api_key=' + api_key
         return url
 
+    def get_coalesce_key(self):
+        return self.__class__.__name__
+
+    def get_batch_items(self):
+        payload = self.decode_data()
+        if isinstance(payload, list):
+            return payload
+        return None
+
+    def make_batch_payload(self, items):
+        return items
+
+
+# Transaction classes by name, for the disk queue
+TRANSACTION_TYPES = dict((cls.__name__, cls) for cls in
+                         (MetricTransaction, APIMetricTransaction, APIServiceCheckTransaction))
+
 
 class StatusHandler(tornado.web.RequestHandler):
 
@@ -373,9 +506,25 @@ class Application(tornado.web.Application):
         self._metrics = {}
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints()
+        throttling_delay = THROTTLING_DELAY
+        if agentConfig.get('forwarder_rate_limit'):
+            throttling_delay = timedelta(seconds=1 / float(agentConfig['forwarder_rate_limit']))
+        store = None
+        if agentConfig.get('forwarder_queue_path'):
+            try:
+                store = SegmentStore(agentConfig['forwarder_queue_path'],
+                                     int(agentConfig.get('forwarder_queue_max_disk_size') or MAX_QUEUE_DISK_SIZE))
+            except Exception:
+                log.exception("Unable to open the disk queue in %s, transactions are only kept in memory"
+                              % agentConfig['forwarder_queue_path'])
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-                                              MAX_QUEUE_SIZE, THROTTLING_DELAY)
+                                              MAX_QUEUE_SIZE, throttling_delay,
+                                              max_in_flight=agentConfig.get('forwarder_max_in_flight') or MAX_IN_FLIGHT,
+                                              max_burst=agentConfig.get('forwarder_max_burst') or MAX_BURST,
+                                              store=store,
+                                              max_batch_size=agentConfig.get('forwarder_max_batch_size', MAX_BATCH_SIZE))
         AgentTransaction.set_tr_manager(self._tr_manager)
+        self._tr_manager.replay(AgentTransaction.from_record)
 
         self._watchdog = None
         self.skip_ssl_validation = skip_ssl_validation or agentConfig.get('skip_ssl_validation', False)
@@ -383,11 +532,59 @@ class Application(tornado.web.Application):
         if self.skip_ssl_validation:
             log.info("Skipping SSL hostname validation, useful when using a transparent proxy")
 
+        # Each transaction is sent to every endpoint
+        max_clients = int(agentConfig.get('forwarder_max_in_flight') or MAX_IN_FLIGHT) \
+            * max(1, len(AgentTransaction._endpoints))
+        self._configure_http_client(max_clients)
+
         if watchdog:
             watchdog_timeout = TRANSACTION_FLUSH_INTERVAL * WATCHDOG_INTERVAL_MULTIPLIER
             self._watchdog = Watchdog(watchdog_timeout,
                                       max_mem_mb=agentConfig.get('limit_memory_consumption', None))
 
+    def _configure_http_client(self, max_clients):
+        """ Configure the HTTP client of the transactions, once for all: the
+        settings shared by their requests are the client defaults. The curl
+        client keeps its connections alive. """
+        config = self._agentConfig
+        proxy_settings = config.get('proxy_settings', None)
+        defaults = {
+            'validate_cert': not self.skip_ssl_validation,
+        }
+
+        force_use_curl = False
+        if proxy_settings is not None:
+            force_use_curl = True
+            if pycurl is not None:
+                log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
+                          proxy_settings['host'], proxy_settings['port']))
+                defaults['proxy_host'] = proxy_settings['host']
+                defaults['proxy_port'] = proxy_settings['port']
+                defaults['proxy_username'] = proxy_settings['user']
+                defaults['proxy_password'] = proxy_settings['password']
+
+                if config.get('proxy_forbid_method_switch'):
+                    # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
+                    defaults['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
+
+        if (not self.use_simple_http_client or force_use_curl) and pycurl is not None:
+            defaults['ca_certs'] = config.get('ssl_certificate', None)
+
+        impl = None
+        use_curl = force_use_curl or config.get("use_curl_http_client") and not self.use_simple_http_client
+        if use_curl:
+            if pycurl is None:
+                log.error("dd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
+            else:
+                log.debug("Using CurlAsyncHTTPClient")
+                impl = "tornado.curl_httpclient.CurlAsyncHTTPClient"
+        else:
+            log.debug("Using SimpleHTTPClient")
+
+        tornado.httpclient.AsyncHTTPClient.configure(impl, max_clients=max_clients, defaults=defaults)
+        AgentTransaction.set_http_client(
+            tornado.httpclient.AsyncHTTPClient(io_loop=get_tornado_ioloop(), force_instance=True))
+
     def log_request(self, handler):
         """ Override the tornado logging method.
         If everything goes well, log level is DEBUG.
@@ -502,6 +699,7 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        self._tr_manager.close()
         log.info("Stopped")
 
     def stop(self):
@@ -549,7 +747,6 @@ def main():
 
     # If we don't have any arguments, run the server.
     if not args:
-        import tornado.httpclient
         app = init(skip_ssl_validation, use_simple_http_client=use_simple_http_client)
         try:
             app.run()
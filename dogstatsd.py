@@ -17,11 +17,16 @@ os.umask(022)
 os.environ['no_proxy'] = '127.0.0.1,localhost'
 
 # stdlib
+from collections import deque
+import errno
+from itertools import islice
 import logging
+import multiprocessing
 import optparse
 import select
 import signal
 import socket
+import stat
 import sys
 import zlib
 from time import time, sleep
@@ -29,11 +34,12 @@ import threading
 from urllib import urlencode
 
 # project
-from aggregator import MetricsBucketAggregator, get_formatter
+from aggregator import MetricNameFilter, MetricsBucketAggregator, get_formatter
 from checks.check_status import DogstatsdStatus
 from config import get_config, get_version
 from daemon import Daemon, AgentSupervisor
-from util import PidFile, get_hostname, plural, get_uuid, chunks
+from util import PidFile, get_hostname, plural, get_uuid, chunks, get_http_sessions
+from utils.sketches import SpaceSaving
 
 # 3rd party
 import requests
@@ -53,6 +59,20 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Seconds to wait for the partial aggregates of a worker process, and for a
+# worker to exit
+WORKER_FLUSH_TIMEOUT = 5
+WORKER_STOP_TIMEOUT = 5
+# Linux value, not exposed by the python 2 socket module
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# Per-socket UDP statistics, including the datagrams dropped by the kernel
+PROC_NET_UDP_PATHS = ['/proc/net/udp', '/proc/net/udp6']
+# Maximum number of datagrams read from the socket for each select() wakeup.
+# The default of 1 keeps the historical one recv() per wakeup behaviour.
+DEFAULT_RECV_BATCH_SIZE = 1
+# Number of metric names and of senders tracked as the heaviest ones, the
+# tracking is disabled by default
+DEFAULT_TOP_K = 0
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -60,6 +80,25 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Maximum size of a compressed series payload, bigger flushes are split
+MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+# Series encoded at once
+SERIES_ENCODE_BATCH = 100
+# Largest share of a payload taken by series encoded at once, past it they
+# are encoded one by one, for payloads to be filled close to their maximum
+# size
+SERIES_ENCODE_MAX_SHARE = 8
+# Bytes of payloads waiting to be sent that are kept in memory, and spilled
+# to disk when a spill directory is set
+SENDER_MAX_QUEUE_SIZE = 32 * 1024 * 1024
+SENDER_MAX_SPILL_SIZE = 256 * 1024 * 1024
+# Seconds between two attempts to send a payload, doubled after each failure
+SENDER_MIN_RETRY_DELAY = 1
+SENDER_MAX_RETRY_DELAY = 60
+HTTP_TIMEOUT = 5
+# Encoded bytes compressed at once, the compressor is flushed after each
+# batch so that the size of the payload is known within a bounded margin
+COMPRESS_SYNC_SIZE = 64 * 1024
 
 
 def serialize_metrics(metrics):
@@ -73,10 +112,129 @@ def serialize_metrics(metrics):
     return serialized, headers
 
 
+def _deflate_bound(size):
+    """ Largest size of `size` bytes once deflated, as zlib's compressBound. """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def _encode_series(metrics, max_size):
+    """ Encoded series of the `metrics` iterable, several at once (comma
+    separated) while they're small enough, one by one otherwise. Encoding
+    each series on its own is much slower. """
+    encode = json.JSONEncoder().encode
+    metrics = iter(metrics)
+    while True:
+        batch = list(islice(metrics, SERIES_ENCODE_BATCH))
+        if not batch:
+            break
+        # Strip the brackets of the list
+        serialized = encode(batch)[1:-1]
+        if len(serialized) <= max_size or len(batch) == 1:
+            yield serialized, batch[0]
+        else:
+            for metric in batch:
+                yield encode(metric), metric
+
+
+def serialize_metrics_payloads(metrics, max_payload_size=MAX_PAYLOAD_SIZE):
+    """
+    Serialize the `metrics` iterable into deflated series payloads of at
+    most `max_payload_size` bytes, yielded as (payload, headers). The series
+    are encoded and compressed in batches, the JSON of the whole list is
+    never built.
+    """
+    headers = {'Content-Type': 'application/json',
+               'Content-Encoding': 'deflate'}
+    header, separator, footer = '{"series": [', ', ', ']}'
+
+    compressor = None
+    chunks = []
+    compressed_size = 0
+    # Encoded series not compressed yet
+    batch = []
+    batch_size = 0
+    for serialized, metric in _encode_series(metrics, max_payload_size // SERIES_ENCODE_MAX_SHARE):
+        size = len(serialized) + len(separator)
+        if _deflate_bound(len(header) + size + len(footer)) > max_payload_size:
+            log.warning("Dropping the series of %s, it's bigger than the maximum payload size" % metric.get('metric'))
+            continue
+
+        if compressor is not None and \
+                compressed_size + _deflate_bound(batch_size + size + len(footer)) > max_payload_size:
+            batch.append(footer)
+            chunks.append(compressor.compress(''.join(batch)))
+            chunks.append(compressor.flush())
+            yield ''.join(chunks), headers
+            compressor = None
+
+        if compressor is None:
+            compressor = zlib.compressobj()
+            chunks = []
+            compressed_size = 0
+            batch = [header, serialized]
+            batch_size = len(header) + len(serialized)
+            continue
+
+        batch.append(separator)
+        batch.append(serialized)
+        batch_size += size
+        if batch_size >= COMPRESS_SYNC_SIZE:
+            # Flushing the compressor makes the size of the output so far exact
+            chunk = compressor.compress(''.join(batch)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            chunks.append(chunk)
+            compressed_size += len(chunk)
+            batch = []
+            batch_size = 0
+
+    if compressor is not None:
+        batch.append(footer)
+        chunks.append(compressor.compress(''.join(batch)))
+        chunks.append(compressor.flush())
+        yield ''.join(chunks), headers
+
+
 def serialize_event(event):
     return json.dumps(event)
 
 
+def get_udp_drops(inodes, paths=None):
+    """
+    Sum the kernel drop counters of the UDP sockets with the given inodes,
+    read from /proc/net/udp and /proc/net/udp6 on Linux.
+    Returns None when they are not available.
+    """
+    paths = paths or PROC_NET_UDP_PATHS
+    drops = None
+    for path in paths:
+        try:
+            with open(path) as proc_file:
+                lines = proc_file.readlines()[1:]
+        except IOError:
+            continue
+
+        for line in lines:
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+            # retrnsmt uid timeout inode ref pointer drops
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            try:
+                if int(fields[9]) in inodes:
+                    drops = (drops or 0) + int(fields[12])
+            except ValueError:
+                continue
+    return drops
+
+
+def format_source(address):
+    """ Printable address of a datagram sender. Only the host is kept, the
+    port changes with each client socket. """
+    if isinstance(address, tuple):
+        return address[0]
+    # Unix socket clients are usually unbound
+    return 'unix:%s' % (address or 'unbound')
+
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
@@ -84,11 +242,16 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, server=None,
+                 top_k_metrics=False, max_payload_size=None, sender=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        self.server = server
+        self.recv_stats = {}
+        self.top_names = ([], [])
+        self.top_k_metrics = top_k_metrics
         self.flush_count = 0
         self.log_count = 0
 
@@ -100,6 +263,9 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        self.max_payload_size = int(max_payload_size or MAX_PAYLOAD_SIZE)
+        # Posts the payloads in the background when set
+        self.sender = sender
 
     def stop(self):
         log.info("Stopping reporter")
@@ -113,17 +279,61 @@ class Reporter(threading.Thread):
         # Persist a start-up message.
         DogstatsdStatus().persist()
 
+        if self.sender is not None:
+            self.sender.start()
+
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            if self.server is not None:
+                try:
+                    self.server.collect()
+                except Exception:
+                    log.exception("Unable to collect the metrics of the dogstatsd workers")
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+            self.metrics_aggregator.submit_metric('datadog.dogstatsd.tags.dedup_ratio',
+                self.metrics_aggregator.tag_sets.dedup_ratio(), 'g')
+            self.submit_context_overflows()
+            if self.server is not None:
+                self.recv_stats = self.server.recv_stats()
+                dropped = self.recv_stats.get('dropped')
+                if dropped is not None:
+                    self.metrics_aggregator.submit_metric('datadog.dogstatsd.packet.dropped', dropped, 'g')
+            self.top_names = self.metrics_aggregator.pop_top_names()
+            if self.top_k_metrics:
+                self.submit_top_k()
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
 
+        if self.sender is not None:
+            self.sender.stop()
+            self.sender.join()
+
         # Clean up the status messages.
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def submit_context_overflows(self):
+        context_overflows = self.metrics_aggregator.pop_context_overflows()
+        if not context_overflows:
+            return
+        names = sorted(context_overflows, key=context_overflows.get, reverse=True)
+        log.warning("%s metrics went over their context budget, the most points over it: %s"
+                    % (len(names), ', '.join(names[:10])))
+        for name in names:
+            self.metrics_aggregator.submit_metric('datadog.dogstatsd.contexts.overflow',
+                context_overflows[name], 'g', tags=['metric_name:%s' % name])
+
+    def submit_top_k(self):
+        submit_metric = self.metrics_aggregator.submit_metric
+        top_packets, top_contexts = self.top_names
+        for name, count in top_packets:
+            submit_metric('datadog.dogstatsd.top.packets', count, 'g', tags=['metric_name:%s' % name])
+        for name, count in top_contexts:
+            submit_metric('datadog.dogstatsd.top.contexts', count, 'g', tags=['metric_name:%s' % name])
+        for source, count in self.recv_stats.get('top_sources', []):
+            submit_metric('datadog.dogstatsd.top.source_packets', count, 'g', tags=['source:%s' % source])
+
     def flush(self):
         try:
             self.flush_count += 1
@@ -131,12 +341,10 @@ class Reporter(threading.Thread):
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
 
-            metrics = self.metrics_aggregator.flush()
-            count = len(metrics)
+            # Serialized as the aggregator formats them
+            count = self.submit(self.metrics_aggregator.iter_flush())
             if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
                 self.log_count = 0
-            if count:
-                self.submit(metrics)
 
             events = self.metrics_aggregator.flush_events()
             event_count = len(events)
@@ -156,6 +364,17 @@ class Reporter(threading.Thread):
             if self.flush_count == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
+            recv_stats = self.recv_stats
+            datagrams_per_wakeup = 0
+            if recv_stats.get('wakeups'):
+                datagrams_per_wakeup = round(float(recv_stats['datagrams']) / recv_stats['wakeups'], 2)
+            socket_path = None
+            if self.server is not None:
+                socket_path = self.server.socket_path
+            sender_stats = {}
+            if self.sender is not None:
+                sender_stats = self.sender.stats()
+
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
             DogstatsdStatus(
@@ -164,6 +383,18 @@ class Reporter(threading.Thread):
                 packets_per_second=packets_per_second,
                 metric_count=count,
                 event_count=event_count,
+                datagrams_per_wakeup=datagrams_per_wakeup,
+                socket_path=socket_path,
+                ring_slots=recv_stats.get('ring_slots'),
+                ring_high_water=recv_stats.get('ring_high_water'),
+                ring_overflow=recv_stats.get('ring_overflow'),
+                top_metric_names=self.top_names[0],
+                top_metric_contexts=self.top_names[1],
+                top_sources=recv_stats.get('top_sources', []),
+                sender_queued=sender_stats.get('queued'),
+                sender_spilled=sender_stats.get('spilled'),
+                sender_dropped=sender_stats.get('dropped'),
+                http_stats=get_http_sessions().stats(),
             ).persist()
 
         except Exception:
@@ -173,12 +404,21 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics)
+        """ Send the series of the `metrics` iterable, returns their count. """
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        count = [0]
+
+        def counted(metrics):
+            for metric in metrics:
+                count[0] += 1
+                yield metric
+
+        for body, headers in serialize_metrics_payloads(counted(metrics), self.max_payload_size):
+            self.submit_http(url, body, headers)
+        return count[0]
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -202,24 +442,10 @@ class Reporter(threading.Thread):
 
     def submit_http(self, url, data, headers):
         headers["DD-Dogstatsd-Version"] = get_version()
-        log.debug("Posting payload to %s" % url)
-        try:
-            start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
-            r.raise_for_status()
-
-            if r.status_code >= 200 and r.status_code < 205:
-                log.debug("Payload accepted")
-
-            status = r.status_code
-            duration = round((time() - start_time) * 1000.0, 4)
-            log.debug("%s POST %s (%sms)" % (status, url, duration))
-        except Exception:
-            log.exception("Unable to post payload.")
-            try:
-                log.error("Received status code: {0}".format(r.status_code))
-            except Exception:
-                pass
+        if self.sender is not None:
+            self.sender.enqueue(url, data, headers)
+        else:
+            post_payload(url, data, headers)
 
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
@@ -232,17 +458,369 @@ class Reporter(threading.Thread):
         self.submit_http(url, json.dumps(service_checks), headers)
 
 
+def post_payload(url, data, headers):
+    """ Post a payload. Returns False when it's worth retrying, i.e. on
+    network errors, server errors and throttling. """
+    log.debug("Posting payload to %s" % url)
+    r = None
+    try:
+        start_time = time()
+        r = get_http_sessions().post(url, data=data, timeout=HTTP_TIMEOUT, headers=headers)
+        r.raise_for_status()
+
+        if r.status_code >= 200 and r.status_code < 205:
+            log.debug("Payload accepted")
+
+        status = r.status_code
+        duration = round((time() - start_time) * 1000.0, 4)
+        log.debug("%s POST %s (%sms)" % (status, url, duration))
+        return True
+    except Exception:
+        log.exception("Unable to post payload.")
+        if r is None:
+            return False
+        log.error("Received status code: {0}".format(r.status_code))
+        return not (r.status_code >= 500 or r.status_code in (408, 429))
+
+
+class PayloadSender(threading.Thread):
+    """
+    Posts the payloads of the reporter from a background thread, so that a
+    slow or unreachable intake doesn't delay the flushes. Failed posts are
+    retried, waiting longer after each failure.
+
+    Payloads wait in memory up to `max_queue_size` bytes. Past it they are
+    spilled to `spill_dir` if set, up to `max_spill_size` bytes, and the
+    oldest payloads are dropped otherwise. Payloads still queued when the
+    sender stops are spilled too, and sent by the next sender on the same
+    directory. Queued and spilled payloads are sent in the order they were
+    enqueued, and the files are written and read without holding the lock
+    of the queue.
+    """
+
+    def __init__(self, max_queue_size=None, spill_dir=None, max_spill_size=None):
+        threading.Thread.__init__(self, name='dogstatsd-sender')
+        self.daemon = True
+        self.max_queue_size = int(max_queue_size or SENDER_MAX_QUEUE_SIZE)
+        self.max_spill_size = int(max_spill_size or SENDER_MAX_SPILL_SIZE)
+        self.spill_dir = spill_dir
+
+        # (key, url, data, headers) tuples, oldest first. Keys, the enqueue
+        # time in milliseconds and a sequence number, order the payloads
+        # across the queue and the spilled ones.
+        self.queue = deque()
+        self.queue_size = 0
+        self.condition = threading.Condition()
+        self.finished = False
+        self.retry_delay = 0
+        self.sequence = 0
+
+        # (key, path, size) of the spilled payloads, oldest first
+        self.spilled = deque()
+        self.spilled_size = 0
+        if spill_dir:
+            if not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            for name in sorted(os.listdir(spill_dir)):
+                if name.endswith('.payload'):
+                    path = os.path.join(spill_dir, name)
+                    size = os.path.getsize(path)
+                    self.spilled.append((self._spilled_key(name), path, size))
+                    self.spilled_size += size
+            if self.spilled:
+                log.info("%s payloads left over in %s will be sent" % (len(self.spilled), spill_dir))
+
+        self.sent_count = 0
+        self.dropped_count = 0
+
+    @staticmethod
+    def _spilled_key(name):
+        try:
+            milliseconds, sequence = name[:-len('.payload')].split('-')
+            return int(milliseconds), int(sequence)
+        except ValueError:
+            return 0, 0
+
+    def enqueue(self, url, data, headers):
+        with self.condition:
+            self.sequence += 1
+            entry = (int(time() * 1000), self.sequence), url, data, headers
+            if self.queue_size + len(data) <= self.max_queue_size:
+                self._append(entry)
+                return
+            spill = self._reserve_spill(len(data))
+
+        if spill and self._spill(entry):
+            return
+
+        with self.condition:
+            while self.queue and self.queue_size + len(data) > self.max_queue_size:
+                self.queue_size -= len(self.queue.popleft()[2])
+                self.dropped_count += 1
+            if len(data) > self.max_queue_size:
+                self.dropped_count += 1
+                log.warning("Dropping a payload of %s bytes, bigger than the sender queue" % len(data))
+                return
+            self._append(entry)
+
+    def _append(self, entry):
+        self.queue.append(entry)
+        self.queue_size += len(entry[2])
+        self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': len(self.queue),
+                'spilled': len(self.spilled),
+                'sent': self.sent_count,
+                'dropped': self.dropped_count,
+            }
+
+    def stop(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.finished or self.queue or self.spilled):
+                    self.condition.wait()
+                if self.finished:
+                    break
+                # The oldest payload, queued or spilled
+                if self.spilled and (not self.queue or self.spilled[0][0] < self.queue[0][0]):
+                    entry = None
+                    key, path, size = self.spilled.popleft()
+                    self.spilled_size -= size
+                else:
+                    entry = self.queue.popleft()
+                    self.queue_size -= len(entry[2])
+
+            if entry is None:
+                entry = self._unspill(key, path)
+                if entry is None:
+                    continue
+
+            if post_payload(*entry[1:]):
+                self.retry_delay = 0
+                self.sent_count += 1
+                continue
+
+            self.retry_delay = min(max(SENDER_MIN_RETRY_DELAY, 2 * self.retry_delay), SENDER_MAX_RETRY_DELAY)
+            log.warning("Retrying to post the payload in %ss" % self.retry_delay)
+            with self.condition:
+                # Put it back first in line, over the size limit if need be
+                self.queue.appendleft(entry)
+                self.queue_size += len(entry[2])
+                if not self.finished:
+                    self.condition.wait(self.retry_delay)
+
+        # Spill what's left, or make a last attempt to send it
+        with self.condition:
+            remaining = list(self.queue)
+            self.queue.clear()
+            self.queue_size = 0
+        reachable = True
+        for entry in remaining:
+            with self.condition:
+                spill = self._reserve_spill(len(entry[2]))
+            if spill and self._spill(entry):
+                continue
+            reachable = reachable and post_payload(*entry[1:])
+            if not reachable:
+                self.dropped_count += 1
+        if not reachable:
+            log.warning("Dropped unsent payloads on exit")
+
+    def _reserve_spill(self, size):
+        """ Count `size` bytes against the spill budget if there is room
+        left. To be called with the lock held. """
+        if not self.spill_dir or self.spilled_size + size > self.max_spill_size:
+            return False
+        self.spilled_size += size
+        return True
+
+    def _spill(self, entry):
+        """ Write a payload to the spill directory, its size reserved with
+        `_reserve_spill`. Called without the lock. """
+        key, url, data, headers = entry
+        path = os.path.join(self.spill_dir, '%013d-%06d.payload' % key)
+        size = 0
+        try:
+            # The url holds the api key
+            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps({'url': url, 'headers': headers}))
+                f.write('\n')
+                f.write(data)
+            os.rename(path + '.tmp', path)
+            size = os.path.getsize(path)
+        except (IOError, OSError), e:
+            log.warning("Unable to spill a payload to %s: %s" % (self.spill_dir, e))
+
+        with self.condition:
+            self.spilled_size += size - len(data)
+            if not size:
+                return False
+            self.spilled.append((key, path, size))
+            self.condition.notify()
+        return True
+
+    def _unspill(self, key, path):
+        """ Read back and delete a spilled payload. Called without the lock. """
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+            os.remove(path)
+        except (IOError, OSError, ValueError), e:
+            log.warning("Unable to read the spilled payload %s: %s" % (path, e))
+            return None
+        return key, meta['url'], data, meta['headers']
+
+
+class PacketRing(object):
+    """
+    A bounded ring of preallocated receive buffers between the thread reading
+    the sockets and the thread parsing the packets, so that a slow parse
+    doesn't stall the reads. There is a single producer and a single consumer,
+    each side only moves its own index.
+    """
+
+    def __init__(self, slots, slot_size):
+        self.slots = int(slots)
+        self.buffers = [bytearray(slot_size) for _ in xrange(self.slots)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.lengths = [0] * self.slots
+        # Datagrams received while the ring is full land here and are dropped
+        self.scratch = bytearray(slot_size)
+
+        # Monotonic positions, the slot of a position is its value modulo `slots`
+        self.head = 0
+        self.tail = 0
+
+        self.overflow_count = 0
+        self.high_water = 0
+        self._not_empty = threading.Event()
+
+    def occupancy(self):
+        return self.head - self.tail
+
+    def fill(self, sock, limit, add_source=None):
+        """ Receive up to `limit` datagrams from the non-blocking `sock`.
+        Returns the number of datagrams read, overflows included. The address
+        of each sender is passed to `add_source` if given. """
+        slots = self.slots
+        buffers = self.buffers
+        lengths = self.lengths
+        head = self.head
+        received = 0
+        try:
+            while received < limit:
+                if head - self.tail >= slots:
+                    address = sock.recvfrom_into(self.scratch)[1]
+                    self.overflow_count += 1
+                else:
+                    index = head % slots
+                    lengths[index], address = sock.recvfrom_into(buffers[index])
+                    head += 1
+                    # Publish the slot once it's filled
+                    self.head = head
+                if add_source is not None:
+                    add_source(address)
+                received += 1
+        except socket.error:
+            # EAGAIN, the socket is drained
+            pass
+
+        occupancy = head - self.tail
+        if occupancy > self.high_water:
+            self.high_water = occupancy
+        if received:
+            self._not_empty.set()
+        return received
+
+    def drain(self, timeout):
+        """ Copy out and release all the filled slots, waiting up to
+        `timeout` seconds for one if the ring is empty. """
+        if self.head == self.tail:
+            self._not_empty.clear()
+            # The producer may have published a slot before the clear
+            if self.head == self.tail:
+                self._not_empty.wait(timeout)
+
+        slots = self.slots
+        views = self.views
+        lengths = self.lengths
+        head = self.head
+        tail = self.tail
+        messages = []
+        while tail < head:
+            index = tail % slots
+            messages.append(views[index][:lengths[index]].tobytes())
+            tail += 1
+        self.tail = tail
+        return messages
+
+
 class Server(object):
     """
     A statsd udp server.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 recv_batch_size=None, reuse_port=False, control_conn=None, socket_path=None,
+                 so_rcvbuf=None, ring_slots=None, flush_aggregator=None, top_k=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
         self.buffer_size = 1024 * 8
+        self.recv_batch_size = max(1, int(recv_batch_size or DEFAULT_RECV_BATCH_SIZE))
+        self.so_rcvbuf = int(so_rcvbuf) if so_rcvbuf else None
+
+        # Optional unix datagram socket, fed into the same pipeline as UDP
+        self.socket_path = socket_path
+        self.unix_socket = None
+
+        # When enabled, the select loop only receives datagrams into the ring
+        # and a separate thread parses them. The lock keeps that thread and
+        # the exports of the aggregator apart.
+        self.ring = None
+        if ring_slots:
+            self.ring = PacketRing(int(ring_slots), self.buffer_size)
+        self.aggregator_lock = threading.Lock()
+        self._last_ring_overflow = 0
+
+        # When set, the reporter flushes this aggregator instead of the one
+        # the server writes to: `collect` swaps the points received since the
+        # last flush out of the latter and merges them into it, so that the
+        # server only waits for the swap.
+        self.flush_aggregator = flush_aggregator
+
+        # Set when the server runs as a worker of a ShardedServer: the socket
+        # is bound with SO_REUSEPORT and the parent process sends commands
+        # through `control_conn`.
+        self.reuse_port = reuse_port
+        self.control_conn = control_conn
+
+        # Number of select() wakeups and of datagrams they drained. Only the
+        # server thread writes them, the reporter keeps its own snapshot.
+        self.wakeup_count = 0
+        self.datagram_count = 0
+        self._last_wakeup_count = 0
+        self._last_datagram_count = 0
+
+        # Senders of the most datagrams
+        self.top_sources = None
+        if top_k:
+            self.top_sources = SpaceSaving(top_k)
+
+        # Inode of the UDP socket, to find its drop counter in /proc
+        self._socket_inode = None
+        self._last_drops = 0
 
         self.running = False
 
@@ -267,6 +845,10 @@ class Server(object):
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.so_rcvbuf:
+            self._set_rcvbuf(self.socket, self.so_rcvbuf)
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -276,12 +858,32 @@ class Server(object):
                 self.socket.bind(self.address)
 
         log.info('Listening on host & port: %s' % str(self.address))
+        # Only used to read the drops in /proc/net/udp. On Windows the socket
+        # isn't a file descriptor
+        if sys.platform.startswith('linux'):
+            self._socket_inode = os.fstat(self.socket.fileno()).st_ino
+
+        if self.socket_path:
+            self.unix_socket = self._bind_unix_socket(self.socket_path)
+            log.info('Listening on unix socket: %s' % self.socket_path)
+        if self.recv_batch_size > 1:
+            log.info('Reading up to %s datagrams per wakeup' % self.recv_batch_size)
 
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        recv_batch_size = self.recv_batch_size
+        ring = self.ring
+        top_sources = self.top_sources
+        add_source = self._add_source if top_sources is not None else None
+        submit_messages = self._submit_messages
+        aggregator_lock = self.aggregator_lock
+        control_conn = self.control_conn
+        sockets = [self.socket]
+        if self.unix_socket is not None:
+            sockets.append(self.unix_socket)
+        if control_conn is not None:
+            sockets.append(control_conn)
+        socket_error = socket.error
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
@@ -290,15 +892,49 @@ class Server(object):
 
         # Run our select loop.
         self.running = True
+
+        parser = None
+        if ring is not None:
+            log.info('Parsing packets in a separate thread, through a ring of %s buffers' % ring.slots)
+            parser = threading.Thread(target=self._parse_ring, name='dogstatsd-parser')
+            parser.daemon = True
+            parser.start()
+
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
+                ready = select_select(sockets, [], [], timeout)[0]
+                for sock in ready:
+                    if sock is control_conn:
+                        self.handle_control()
+                        continue
+
+                    self.wakeup_count += 1
+                    if ring is not None:
+                        self.datagram_count += ring.fill(sock, recv_batch_size, add_source)
+                        continue
+
+                    if add_source is not None:
+                        messages = self._recv_from_batch(sock, add_source)
+                    else:
+                        socket_recv = sock.recv
+                        messages = [socket_recv(buffer_size)]
+
+                        # Drain the datagrams already queued in the kernel, the
+                        # socket is non-blocking so we stop on EAGAIN.
+                        while len(messages) < recv_batch_size:
+                            try:
+                                messages.append(socket_recv(buffer_size))
+                            except socket_error:
+                                break
+
+                    self.datagram_count += len(messages)
+
+                    with aggregator_lock:
+                        submit_messages(messages)
 
                     if should_forward:
-                        forward_udp_sock.send(message)
+                        for message in messages:
+                            forward_udp_sock.send(message)
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
                 errno = se[0]
@@ -309,8 +945,336 @@ class Server(object):
             except Exception:
                 log.exception('Error receiving datagram')
 
+        if parser is not None:
+            parser.join()
+
+        # Release the port, other workers may be bound to it
+        self.socket.close()
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            self._remove_socket_file(self.socket_path)
+
+    def _submit_messages(self, messages):
+        """ Parse a batch of datagrams, each on its own so that a malformed
+        one doesn't lose the next ones. """
+        aggregator_submit = self.metrics_aggregator.submit_packets
+        for message in messages:
+            try:
+                aggregator_submit(message)
+            except Exception:
+                log.exception('Error parsing datagram')
+
+    def _add_source(self, address):
+        self.top_sources.add(format_source(address))
+
+    def _recv_from_batch(self, sock, add_source):
+        """ Same as the batched recv of the select loop, also passing the
+        address of each sender to `add_source`. """
+        socket_recvfrom = sock.recvfrom
+        message, address = socket_recvfrom(self.buffer_size)
+        add_source(address)
+        messages = [message]
+        while len(messages) < self.recv_batch_size:
+            try:
+                message, address = socket_recvfrom(self.buffer_size)
+            except socket.error:
+                break
+            add_source(address)
+            messages.append(message)
+        return messages
+
+    def _parse_ring(self):
+        """ Consume the datagrams queued in the ring by the select loop. """
+        ring = self.ring
+        submit_messages = self._submit_messages
+        aggregator_lock = self.aggregator_lock
+        timeout = UDP_SOCKET_TIMEOUT
+        should_forward = self.should_forward
+        forward_udp_sock = self.forward_udp_sock
+
+        while self.running:
+            messages = ring.drain(timeout)
+            if not messages:
+                continue
+            try:
+                with aggregator_lock:
+                    submit_messages(messages)
+
+                if should_forward:
+                    for message in messages:
+                        forward_udp_sock.send(message)
+            except Exception:
+                log.exception('Error parsing datagram')
+
+    @staticmethod
+    def _set_rcvbuf(sock, size):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        expected = size
+        if sys.platform.startswith('linux'):
+            # Linux doubles the value for bookkeeping overhead, after
+            # capping it to net.core.rmem_max
+            expected = 2 * size
+        if actual < expected:
+            log.warning("Socket receive buffer capped to %s bytes instead of %s, "
+                        "raise net.core.rmem_max to allow more" % (actual, expected))
+        else:
+            log.info("Socket receive buffer size: %s bytes" % actual)
+
+    def _bind_unix_socket(self, path):
+        """
+        Bind a non-blocking unix datagram socket. Unlike UDP, a client writing
+        to a full socket gets EAGAIN (or blocks) instead of losing the packet
+        silently.
+        """
+        self._remove_socket_file(path)
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        unix_socket.setblocking(0)
+        unix_socket.bind(path)
+        # Clients need write access to the socket to send to it
+        os.chmod(path, 0666)
+        return unix_socket
+
+    @staticmethod
+    def _remove_socket_file(path):
+        # Remove the socket left behind by a previous run, and nothing else
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if not stat.S_ISSOCK(mode):
+            raise OSError(errno.EEXIST, "Not a socket, refusing to replace it", path)
+        os.unlink(path)
+
+    def handle_control(self):
+        """ Answer a command sent by the ShardedServer owning this worker. """
+        try:
+            command = self.control_conn.recv()
+        except EOFError:
+            # The parent process is gone
+            log.warning("Lost the connection to the dogstatsd parent process, stopping")
+            self.running = False
+            return
+
+        command, seq = command
+        if command == 'flush':
+            with self.aggregator_lock:
+                state = self.metrics_aggregator.export_state()
+            self.control_conn.send((seq, state, self.recv_stats()))
+        elif command == 'stop':
+            self.running = False
+
+    def recv_stats(self):
+        """
+        Receive statistics since the last call: number of select() wakeups,
+        of datagrams they drained and of datagrams dropped by the kernel
+        (None when it can't be known). With a ring, also its size, highest
+        occupancy and number of datagrams dropped because it was full. With
+        the sender tracking, the senders of the most datagrams.
+        """
+        wakeup_count, datagram_count = self.wakeup_count, self.datagram_count
+        stats = {
+            'wakeups': wakeup_count - self._last_wakeup_count,
+            'datagrams': datagram_count - self._last_datagram_count,
+            'dropped': self.dropped_packets(),
+        }
+        self._last_wakeup_count = wakeup_count
+        self._last_datagram_count = datagram_count
+
+        ring = self.ring
+        if ring is not None:
+            overflow_count = ring.overflow_count
+            stats['ring_slots'] = ring.slots
+            stats['ring_high_water'] = ring.high_water
+            stats['ring_overflow'] = overflow_count - self._last_ring_overflow
+            self._last_ring_overflow = overflow_count
+            ring.high_water = ring.occupancy()
+
+        if self.top_sources is not None:
+            stats['top_sources'] = self.top_sources.pop_top()
+
+        return stats
+
+    def dropped_packets(self):
+        """ Number of datagrams dropped by the kernel on the UDP socket since
+        the last call, or None if it can't be known. """
+        if self._socket_inode is None:
+            return None
+        drops = get_udp_drops([self._socket_inode])
+        if drops is None:
+            return None
+        dropped = drops - self._last_drops
+        self._last_drops = drops
+        return dropped
+
+    def collect(self):
+        """ Called by the reporter before each flush. """
+        if self.flush_aggregator is None:
+            # The aggregator is shared with the reporter
+            return
+        with self.aggregator_lock:
+            state = self.metrics_aggregator.export_state()
+        self.flush_aggregator.merge_state(state)
+
+    def stop(self):
+        self.running = False
+
+
+def _reset_logging_locks():
+    logging._lock = threading.RLock()
+    for handler_ref in logging._handlerList:
+        handler = handler_ref()
+        if handler is not None:
+            handler.createLock()
+
+
+class ServerWorker(multiprocessing.Process):
+    """ A process running one shard of a ShardedServer. """
+
+    def __init__(self, server):
+        multiprocessing.Process.__init__(self, name='dogstatsd-worker')
+        self.server = server
+        self.daemon = True
+
+    def run(self):
+        # Another thread of the parent process may have held a logging lock
+        # when it forked, it would never be released here.
+        _reset_logging_locks()
+
+        # The parent process handles interruptions and tells us to stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.server.stop())
+        self.server.start()
+
+
+class ShardedServer(object):
+    """
+    Spreads the parsing of statsd packets over several worker processes.
+
+    Each worker runs a Server that binds the same port with SO_REUSEPORT, so
+    that the kernel balances the datagrams between them, and owns its own
+    aggregator. Before each flush the reporter calls `collect`, which merges
+    the partial aggregates of every worker into `metrics_aggregator`: the
+    series are only flushed from there, once per context.
+    """
+
+    def __init__(self, metrics_aggregator, aggregator_factory, workers, host, port,
+                 socket_path=None, **server_kwargs):
+        self.metrics_aggregator = metrics_aggregator
+        self.aggregator_factory = aggregator_factory
+        self.worker_count = int(workers)
+        self.host = host
+        self.port = int(port)
+        # Only the first worker listens on the unix socket, a path can't be
+        # bound more than once.
+        self.socket_path = socket_path
+        self.server_kwargs = server_kwargs
+        self.workers = []
+        self.running = False
+        self.finished = threading.Event()
+
+        # Receive statistics of the workers, summed until the next
+        # `recv_stats` call
+        self._recv_stats = {}
+
+        # Number of the last flush request, to tell late replies apart
+        self._flush_seq = 0
+
+    def _spawn_worker(self, index):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        socket_path = self.socket_path if index == 0 else None
+        server = Server(self.aggregator_factory(), self.host, self.port,
+                        reuse_port=True, control_conn=child_conn, socket_path=socket_path,
+                        **self.server_kwargs)
+        worker = ServerWorker(server)
+        worker.start()
+        return worker, parent_conn
+
+    def start_workers(self):
+        """ Fork the workers. To be called before starting any thread, see
+        `_reset_logging_locks`. """
+        if self.workers:
+            return
+        log.info("Starting %s dogstatsd workers sharing port %s" % (self.worker_count, self.port))
+        self.workers = [self._spawn_worker(i) for i in xrange(self.worker_count)]
+
+    def start(self):
+        """ Start the workers if needed and block until the server is stopped. """
+        self.start_workers()
+        self.running = True
+
+        while self.running:
+            self.finished.wait(1)
+            for i, (worker, conn) in enumerate(self.workers):
+                if self.running and not worker.is_alive():
+                    log.error("Dogstatsd worker %s died with exit code %s, restarting it" % (worker.pid, worker.exitcode))
+                    self.workers[i] = self._spawn_worker(i)
+
+        for worker, conn in self.workers:
+            try:
+                conn.send(('stop', None))
+            except Exception:
+                pass
+        for worker, conn in self.workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+    def collect(self):
+        """ Merge the partial aggregates of the workers. """
+        workers = [(worker, conn) for worker, conn in self.workers if worker.is_alive()]
+        self._flush_seq += 1
+        seq = self._flush_seq
+        for worker, conn in workers:
+            conn.send(('flush', seq))
+
+        deadline = time() + WORKER_FLUSH_TIMEOUT
+        for worker, conn in workers:
+            reply = None
+            while conn.poll(max(0, deadline - time())):
+                reply = conn.recv()
+                if reply[0] == seq:
+                    break
+                # The answer to a request that timed out, its buckets were
+                # flushed without it
+                log.warning("Discarding a late flush reply of dogstatsd worker %s" % worker.pid)
+                reply = None
+            if reply is None:
+                log.warning("Dogstatsd worker %s didn't answer the flush request" % worker.pid)
+                continue
+            _, state, stats = reply
+            self.metrics_aggregator.merge_state(state)
+            self._merge_recv_stats(stats)
+
+    def _merge_recv_stats(self, stats):
+        merged = self._recv_stats
+        for key, value in stats.iteritems():
+            if value is None:
+                continue
+            if key == 'top_sources':
+                top_sources = merged.setdefault(key, {})
+                for source, count in value:
+                    top_sources[source] = top_sources.get(source, 0) + count
+            elif key == 'ring_high_water':
+                merged[key] = max(merged.get(key, 0), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    def recv_stats(self):
+        """ Receive statistics of all the workers since the last call, see
+        `Server.recv_stats`. """
+        stats, self._recv_stats = self._recv_stats, {}
+        stats.setdefault('dropped', None)
+        if 'top_sources' in stats:
+            stats['top_sources'] = sorted(stats['top_sources'].iteritems(),
+                                          key=lambda item: item[1], reverse=True)
+        return stats
+
     def stop(self):
         self.running = False
+        self.finished.set()
 
 
 class Dogstatsd(Daemon):
@@ -332,6 +1296,10 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # Fork the workers while this process has no other thread
+        if isinstance(self.server, ShardedServer):
+            self.server.start_workers()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -381,6 +1349,21 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     forward_to_port = c.get('statsd_forward_port')
     event_chunk_size = c.get('event_chunk_size')
     recent_point_threshold = c.get('recent_point_threshold', None)
+    recv_batch_size = c.get('dogstatsd_recv_batch_size')
+    workers = int(c.get('dogstatsd_workers') or 1)
+    socket_path = c.get('dogstatsd_socket')
+    so_rcvbuf = c.get('dogstatsd_so_rcvbuf')
+    ring_slots = c.get('dogstatsd_ring_slots')
+    max_contexts_per_name = c.get('dogstatsd_max_contexts_per_metric')
+    max_contexts = c.get('dogstatsd_max_contexts')
+    context_overflow = c.get('dogstatsd_context_overflow')
+    top_k = int(c.get('dogstatsd_top_k', DEFAULT_TOP_K) or 0)
+    name_filter_rules = {
+        'allow': c.get('dogstatsd_metric_allow'),
+        'deny': c.get('dogstatsd_metric_deny'),
+        'deny_regex': c.get('dogstatsd_metric_deny_regex'),
+        'rename': c.get('dogstatsd_metric_rename'),
+    }
 
     target = c['dd_url']
     if use_forwarder:
@@ -392,18 +1375,26 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(c),
-        histogram_aggregates=c.get('histogram_aggregates'),
-        histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
-    )
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    def aggregator_factory():
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=get_formatter(c),
+            histogram_aggregates=c.get('histogram_aggregates'),
+            histogram_percentiles=c.get('histogram_percentiles'),
+            utf8_decoding=c['utf8_decoding'],
+            context_cache_size=c.get('dogstatsd_context_cache_size'),
+            histogram_sketch=c.get('histogram_sketch', False),
+            set_hyperloglog=c.get('set_hyperloglog', False),
+            top_k=top_k,
+            name_filter=MetricNameFilter(**name_filter_rules),
+            max_contexts_per_name=max_contexts_per_name,
+            max_contexts=max_contexts,
+            context_overflow=context_overflow
+        )
+
+    aggregator = aggregator_factory()
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -412,7 +1403,31 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    if workers > 1:
+        # Every worker parses its share of the traffic, `aggregator` only
+        # receives their merged partial aggregates.
+        server = ShardedServer(aggregator, aggregator_factory, workers, server_host, port,
+                               forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                               recv_batch_size=recv_batch_size, socket_path=socket_path,
+                               so_rcvbuf=so_rcvbuf, ring_slots=ring_slots, top_k=top_k)
+    else:
+        # The server writes to its own aggregator, handed over to `aggregator`
+        # before each flush.
+        server = Server(aggregator_factory(), server_host, port, forward_to_host=forward_to_host,
+                        forward_to_port=forward_to_port, recv_batch_size=recv_batch_size,
+                        socket_path=socket_path, so_rcvbuf=so_rcvbuf, ring_slots=ring_slots,
+                        flush_aggregator=aggregator, top_k=top_k)
+
+    # Payloads are posted in the background, a slow intake doesn't delay the
+    # flushes
+    sender = PayloadSender(max_queue_size=c.get('dogstatsd_queue_max_size'),
+                           spill_dir=c.get('dogstatsd_spill_dir'),
+                           max_spill_size=c.get('dogstatsd_spill_max_size'))
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        server=server, top_k_metrics=c.get('dogstatsd_top_k_metrics', False),
+                        max_payload_size=c.get('dogstatsd_max_payload_size'), sender=sender)
 
     return reporter, server, c
 
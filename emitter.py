@@ -12,6 +12,7 @@ import simplejson as json
 
 # project
 from config import get_version
+from util import get_http_sessions
 
 # Starting with Agent 5.0.0, there should always be a local forwarder
 # running and all payloads should go through it. So we should make sure
@@ -56,7 +57,7 @@ def http_emitter(message, log, agentConfig):
 
     try:
         headers = post_headers(agentConfig, zipped)
-        r = requests.post(url, data=zipped, timeout=5, headers=headers)
+        r = get_http_sessions().post(url, data=zipped, timeout=5, headers=headers)
 
         r.raise_for_status()
 
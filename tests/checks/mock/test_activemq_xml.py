@@ -23,23 +23,23 @@ instances:
         # not too concerned with the response body, just that requests.get was called
         # with the correct arguments
         check, instances = get_check('activemq_xml', self.config)
-        check.requests = mock.Mock()
+        check.http = mock.Mock()
         check._fetch_data('http://localhost:8171', '/admin/xml/queues.jsp', None, None)
-        assert check.requests.get.call_count == 1
-        assert check.requests.get.call_args == mock.call(
+        assert check.http.get.call_count == 1
+        assert check.http.get.call_args == mock.call(
             'http://localhost:8171/admin/xml/queues.jsp', auth=None
         )
 
-        check.requests.get.reset_mock()
+        check.http.get.reset_mock()
         check._fetch_data('http://localhost:8171', '/admin/xml/queues.jsp', 'user', 'pass')
-        assert check.requests.get.call_count == 1
-        assert check.requests.get.call_args == mock.call(
+        assert check.http.get.call_count == 1
+        assert check.http.get.call_args == mock.call(
             'http://localhost:8171/admin/xml/queues.jsp', auth=('user', 'pass')
         )
 
     def test_check(self):
         check, instances = get_check('activemq_xml', self.config)
-        check.requests = mock.Mock()
+        check.http = mock.Mock()
 
         def response_side_effect(*args, **kwargs):
             text = ''
@@ -53,7 +53,7 @@ instances:
             # (which is what we want if we called with a url we dont know)
             return mock.Mock(text=text)
 
-        check.requests.get.side_effect = response_side_effect
+        check.http.get.side_effect = response_side_effect
         check.check(instances[0])
         expected = {
             'url:http://localhost:8161': {
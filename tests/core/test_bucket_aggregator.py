@@ -5,11 +5,12 @@ import time
 import unittest
 
 # 3p
+import mock
 from nose.plugins.attrib import attr
 import nose.tools as nt
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES
+from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, Counter
 from dogstatsd import MetricsBucketAggregator
 
 
@@ -182,6 +183,28 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equals(metrics[0]['metric'], 'my.first.counter')
         nt.assert_equals(metrics[0]['points'][0][1], 1)
 
+    def test_iter_flush(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        for i in xrange(10):
+            stats.submit_packets('my.counter.%s:1|c' % i)
+            stats.submit_packets('my.gauge.%s:1|g' % i)
+        self.sleep_for_interval_length(ag_interval)
+
+        # Points keep coming while the metrics are consumed
+        names = []
+        for metric in stats.iter_flush():
+            names.append(metric['metric'])
+            stats.submit_packets('my.late.counter.%s:1|c' % len(names))
+            stats.submit_packets('my.late.gauge.%s:1|g' % len(names))
+        nt.assert_equals(sorted(names), sorted(['my.counter.%s' % i for i in xrange(10)] +
+                                               ['my.gauge.%s' % i for i in xrange(10)]))
+
+        self.sleep_for_interval_length(ag_interval)
+        metrics = stats.flush()
+        nt.assert_equals(len([m for m in metrics if m['metric'].startswith('my.late.gauge')]), 20)
+        nt.assert_equals(len([m for m in metrics if m['metric'].startswith('my.counter')]), 10)
+
     def test_counter_buckets(self):
         ag_interval = 5
         stats = MetricsBucketAggregator('myhost', interval=ag_interval)
@@ -217,6 +240,9 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equals(second['points'][0][1], 1)
         nt.assert_equals(second_b['metric'], 'my.second.counter')
         nt.assert_equals(second_b['points'][0][1], 0)
+        # As flushed by an empty counter
+        empty = Counter(stats.formatter, 'my.second.counter', (), 'myhost', None).flush(0, stats.interval)
+        nt.assert_equals(repr(second_b['points'][0][1]), repr(empty[0]['points'][0][1]))
 
         nt.assert_equals(third['metric'], 'my.third.counter')
         nt.assert_equals(third['points'][0][1], 3)
@@ -753,6 +779,72 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
             else:
                 assert False, 'invalid : %s' % packet
 
+    def test_context_budgets(self):
+        stats = MetricsBucketAggregator('myhost', interval=1, max_contexts_per_name=3, max_contexts=5)
+        for i in xrange(10):
+            stats.submit_packets('my.counter:1|c|#request:%s' % i)
+        stats.submit_packets('my.counter:1|c|#request:0')
+        for i in xrange(4):
+            stats.submit_packets('my.gauge:%s|g|#id:%s' % (i, i))
+        stats.submit_packets('my.histogram:1|h|#id:0')
+
+        nt.assert_equal(stats.pop_context_overflows(), {'my.counter': 7, 'my.gauge': 2, 'my.histogram': 1})
+        nt.assert_equal(stats.pop_context_overflows(), {})
+
+        self.sleep_for_interval_length()
+        metrics = [(m['metric'], m['tags'], m['points'][0][1]) for m in stats.flush()]
+        nt.assert_equal(sorted(metrics), [
+            ('my.counter', ('overflow:true',), 7),
+            ('my.counter', ('request:0',), 2),
+            ('my.counter', ('request:1',), 1),
+            ('my.counter', ('request:2',), 1),
+            ('my.gauge', ('id:0',), 0),
+            ('my.gauge', ('id:1',), 1),
+            ('my.gauge', ('overflow:true',), 3),
+            ('my.histogram.95percentile', ('overflow:true',), 1),
+            ('my.histogram.avg', ('overflow:true',), 1),
+            ('my.histogram.count', ('overflow:true',), 1),
+            ('my.histogram.max', ('overflow:true',), 1),
+            ('my.histogram.median', ('overflow:true',), 1),
+        ])
+
+        # Budgets apply per bucket
+        stats = MetricsBucketAggregator('myhost', interval=1, max_contexts_per_name=1,
+                                        context_overflow='drop')
+        stats.submit_packets('my.counter:1|c|#request:0\nmy.counter:1|c|#request:1')
+        self.sleep_for_interval_length()
+        stats.submit_packets('my.counter:1|c|#request:1\nmy.counter:1|c|#request:2')
+        nt.assert_equal(stats.pop_context_overflows(), {'my.counter': 2})
+        self.sleep_for_interval_length()
+        metrics = [(m['tags'], m['points'][0][1]) for m in stats.flush()]
+        nt.assert_equal(sorted(metrics), [(('request:0',), 0.0), (('request:0',), 1), (('request:1',), 1)])
+
+    def test_counter_expiry_index(self):
+        import aggregator
+        now = [1000.0]
+        with mock.patch.object(aggregator, 'time', lambda: now[0]):
+            stats = MetricsBucketAggregator('myhost', interval=1, expiry_seconds=5)
+            stats.submit_packets('my.counter.0:1|c\nmy.counter.1:1|c\nmy.counter.2:1|c')
+            for _ in xrange(2000):
+                now[0] += 1
+                metrics = stats.flush()
+                stats.submit_packets('my.counter.0:1|c')
+
+            # The idle counters reported 0 until they expired
+            nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics], [('my.counter.0', 1)])
+            nt.assert_equal(stats.last_sample_time_by_context.keys(), [('my.counter.0', (), 'myhost', None)])
+            # Superseded entries of the expiry heap are dropped
+            assert len(stats.counter_expiry_heap) <= 1026
+
+            now[0] += 1
+            nt.assert_equal([(m['metric'], m['points'][0][1]) for m in stats.flush()], [('my.counter.0', 1)])
+            now[0] += 1
+            nt.assert_equal([(m['metric'], m['points'][0][1]) for m in stats.flush()], [('my.counter.0', 0.0)])
+
+            now[0] += 10
+            nt.assert_equal(stats.flush(), [])
+            nt.assert_equal(stats.last_sample_time_by_context, {})
+
     def test_metrics_expiry(self):
         # Ensure metrics eventually expire and stop submitting.
         ag_interval = self.interval
@@ -1026,6 +1118,79 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equal(h1['points'][0][0], h4['points'][0][0])
         nt.assert_equal(h1['points'][0][0], h5['points'][0][0])
 
+    def test_merge_state(self):
+        import pickle
+        ag_interval = 1
+        shards = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in range(2)]
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for i, shard in enumerate(shards):
+            shard.submit_packets('my.counter:%s|c|#shard' % (i + 1))
+            shard.submit_packets('my.gauge:%s|g' % (i + 1))
+            shard.submit_packets('my.set:%s|s' % i)
+            shard.submit_packets('my.set:common|s')
+            shard.submit_packets('my.histogram:%s|h' % (i + 1))
+            shard.submit_packets('_e{5,4}:title|text')
+
+        for shard in shards:
+            stats.merge_state(pickle.loads(pickle.dumps(shard.export_state())))
+        nt.assert_equal(shards[0].flush(), [])
+        nt.assert_equal(stats.count, 10)
+
+        self.sleep_for_interval_length(ag_interval)
+        metrics = self.sort_metrics(stats.flush())
+        values = dict((m['metric'], m['points'][0][1]) for m in metrics)
+
+        nt.assert_equal(len(metrics), 8)
+        nt.assert_equal(values['my.counter'], 3)
+        nt.assert_equal(values['my.gauge'], 2)
+        nt.assert_equal(values['my.set'], 3)
+        nt.assert_equal(values['my.histogram.count'], 2)
+        nt.assert_equal(values['my.histogram.max'], 2)
+        nt.assert_equal(len(stats.flush_events()), 2)
+
+    def test_merge_state_context_budgets(self):
+        ag_interval = 1
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval, max_contexts_per_name=2)
+        shard = MetricsBucketAggregator('myhost', interval=ag_interval, max_contexts_per_name=2)
+
+        # One bucket over two exports
+        self.wait_for_bucket_boundary(ag_interval)
+        for i in xrange(2):
+            shard.submit_packets('my.counter:1|c|#request:%s' % i)
+        stats.merge_state(shard.export_state())
+        for i in xrange(2, 5):
+            shard.submit_packets('my.counter:1|c|#request:%s' % i)
+        stats.merge_state(shard.export_state())
+        nt.assert_equal(stats.pop_context_overflows(), {'my.counter': 3})
+
+        self.sleep_for_interval_length(ag_interval)
+        metrics = [(m['tags'], m['points'][0][1]) for m in stats.flush()]
+        nt.assert_equal(sorted(metrics), [
+            (('overflow:true',), 3),
+            (('request:0',), 1),
+            (('request:1',), 1),
+        ])
+
+    def test_merge_state_type_change(self):
+        ag_interval = 1
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        self.wait_for_bucket_boundary(ag_interval)
+        for types in [('g', 'c'), ('h', 'c'), ('s', 'c'), ('c', 'h')]:
+            shards = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in types]
+            for shard, metric_type in zip(shards, types):
+                shard.submit_packets('my.%s%s:1|%s' % (types + (metric_type,)))
+            # The metric of the first shard is kept
+            for shard in shards:
+                stats.merge_state(shard.export_state())
+
+        self.sleep_for_interval_length(ag_interval)
+        names = set(m['metric'] for m in stats.flush())
+        for name in ['my.ch', 'my.gc', 'my.hc.count', 'my.sc']:
+            nt.assert_true(name in names, name)
+        nt.assert_false('my.ch.count' in names)
+
     def test_calculate_bucket_start(self):
         stats = MetricsBucketAggregator('myhost', interval=10)
         nt.assert_equal(stats.calculate_bucket_start(13284283), 13284280)
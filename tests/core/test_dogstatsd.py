@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import pickle
 import random
+import socket
+import sys
+import threading
 import time
 import unittest
 
 # 3p
+import mock
 from nose.plugins.attrib import attr
 import nose.tools as nt
 
@@ -170,6 +175,37 @@ class TestUnitDogStatsd(unittest.TestCase):
         serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')])
         assert '"tags": ["tag"]' in serialized[0]
 
+    def test_serialize_metrics_payloads(self):
+        import json
+        import zlib
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter('payload.metric.%s' % i, i, 1, ('tag:%s' % random.random(),), 'host')
+                   for i in xrange(5000)]
+        payloads = list(dogstatsd.serialize_metrics_payloads(metrics, 50000))
+        assert len(payloads) > 1
+
+        series = []
+        for payload, headers in payloads:
+            nt.assert_equal(headers['Content-Encoding'], 'deflate')
+            assert len(payload) <= 50000
+            series += json.loads(zlib.decompress(payload))['series']
+        nt.assert_equal([s['metric'] for s in series], [m['metric'] for m in metrics])
+        nt.assert_equal(series[42]['tags'], list(metrics[42]['tags']))
+
+        small_payloads = list(dogstatsd.serialize_metrics_payloads(metrics[:3]))
+        nt.assert_equal(len(small_payloads), 1)
+        nt.assert_equal(len(json.loads(zlib.decompress(small_payloads[0][0]))['series']), 3)
+        nt.assert_equal(list(dogstatsd.serialize_metrics_payloads([])), [])
+        # Any iterable of metrics
+        nt.assert_equal(list(dogstatsd.serialize_metrics_payloads(iter(metrics), 50000)), payloads)
+
+        reporter = dogstatsd.Reporter(10, None, 'http://localhost', max_payload_size=50000)
+        with mock.patch.object(reporter, 'submit_http') as submit_http:
+            nt.assert_equal(reporter.submit(iter(metrics)), 5000)
+        nt.assert_equal(submit_http.call_count, len(payloads))
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -269,6 +305,137 @@ class TestUnitDogStatsd(unittest.TestCase):
         # Assert there are no more sets
         assert not stats.flush()
 
+    def test_hyperloglog_sets(self):
+        stats = MetricsAggregator('myhost', set_hyperloglog=True)
+        for i in xrange(3):
+            stats.submit_packets('my.set:10|s\nmy.set:20|s\nmy.set:30|s')
+        for i in xrange(20000):
+            stats.submit_packets('my.big.set:user-%s|s' % (i % 10000))
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([m['metric'] for m in metrics], ['my.big.set', 'my.set'])
+        # Small sets are exact
+        nt.assert_equal(metrics[1]['points'][0][1], 3)
+        assert abs(metrics[0]['points'][0][1] - 10000) < 300
+
+        assert not stats.flush()
+
+    def test_hyperloglog_merge(self):
+        from utils.sketches import HyperLogLog
+
+        sketches = [HyperLogLog() for _ in xrange(3)]
+        for i in xrange(30000):
+            sketches[i % 3].add('request-%s' % i)
+        for i in xrange(100):
+            sketches[0].add('request-%s' % i)
+
+        merged = HyperLogLog()
+        small = HyperLogLog()
+        small.add('request-0')
+        small.add('other')
+        merged.merge(small)
+        nt.assert_equal(len(merged), 2)
+        for sketch in sketches:
+            merged.merge(sketch)
+        assert abs(len(merged) - 30001) < 900
+        nt.assert_equal(len(merged.registers), 2 ** 14)
+
+    def test_space_saving(self):
+        from utils.sketches import SpaceSaving
+
+        top = SpaceSaving(3)
+        for i in xrange(1000):
+            top.add('heavy')
+            if i % 2:
+                top.add('medium')
+            top.add('light-%s' % i)
+        nt.assert_equal(len(top), 3)
+        (heavy, heavy_count), (medium, medium_count) = top.top(2)
+        nt.assert_equal((heavy, heavy_count), ('heavy', 1000))
+        # Overestimated by at most the total count over the capacity
+        nt.assert_equal(medium, 'medium')
+        assert 500 <= medium_count <= 500 + 2500 / 3
+
+        other = SpaceSaving(3)
+        other.add('medium', 600)
+        top.merge(other)
+        nt.assert_equal(top.pop_top(1), [('medium', medium_count + 600)])
+        nt.assert_equal(top.top(), [])
+
+    def test_space_saving_evicts_least_counted(self):
+        from utils.sketches import SpaceSaving
+
+        # Same eviction as a scan for the least counted key, ties broken by key
+        top, expected = SpaceSaving(10), {}
+        rand = random.Random(0)
+        for _ in xrange(5000):
+            key, count = rand.randint(0, 40), rand.randint(1, 3)
+            top.add(key, count)
+            if key in expected:
+                expected[key] += count
+            elif len(expected) < 10:
+                expected[key] = count
+            else:
+                evicted = min(expected, key=lambda k: (expected[k], k))
+                expected[key] = expected.pop(evicted) + count
+            nt.assert_equal(top.counts, expected)
+
+        # Exported along with the aggregator state
+        restored = pickle.loads(pickle.dumps(top))
+        restored.add('new')
+        nt.assert_equal(len(restored), 10)
+        nt.assert_equal(top.counts, expected)
+
+    def test_top_names(self):
+        stats = MetricsAggregator('myhost', top_k=3)
+        for i in xrange(10):
+            stats.submit_packets('top.packets:1|c')
+            stats.submit_packets('top.contexts:1|c|#id:%s' % i)
+        stats.submit_packets('top.other:1|c')
+
+        top_packets, top_contexts = stats.pop_top_names()
+        nt.assert_equal(sorted(top_packets), [('top.contexts', 10), ('top.other', 1), ('top.packets', 10)])
+        nt.assert_equal(top_contexts[0], ('top.contexts', 10))
+        nt.assert_equal(stats.pop_top_names(), ([], []))
+        nt.assert_equal(MetricsAggregator('myhost').pop_top_names(), ([], []))
+
+    def test_metric_name_filter(self):
+        from aggregator import MetricNameFilter
+
+        name_filter = MetricNameFilter(allow='app., lib.', deny='lib.debug.',
+                                       deny_regex=r'.*\.tmp$',
+                                       rename='lib.old.:lib.new., lib.old.deep.:lib.deep.')
+        nt.assert_equal(name_filter.resolve('app.requests'), 'app.requests')
+        nt.assert_equal(name_filter.resolve('other.requests'), None)
+        nt.assert_equal(name_filter.resolve('lib.debug.timer'), None)
+        nt.assert_equal(name_filter.resolve('app.cache.tmp'), None)
+        nt.assert_equal(name_filter.resolve('lib.old.timer'), 'lib.new.timer')
+        # The longest prefix wins
+        nt.assert_equal(name_filter.resolve('lib.old.deep.timer'), 'lib.deep.timer')
+        # Cached outcomes
+        nt.assert_equal(name_filter.resolve('lib.old.timer'), 'lib.new.timer')
+        nt.assert_equal(name_filter.resolve('other.requests'), None)
+
+        # Invalid rules are ignored
+        nt.assert_false(MetricNameFilter(deny_regex='(', rename='nocolon').is_active())
+
+    def test_metric_name_filter_packets(self):
+        from aggregator import MetricNameFilter
+
+        name_filter = MetricNameFilter(deny='noisy.', rename='old.:new.')
+        stats = MetricsAggregator('myhost', name_filter=name_filter)
+        for _ in xrange(2):
+            stats.submit_packets('noisy.timer:1|ms')
+            stats.submit_packets('old.counter:1|c|#env:prod')
+            stats.submit_packets('kept.gauge:1|g')
+        nt.assert_equal(stats.num_filtered_points, 2)
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([m['metric'] for m in metrics], ['kept.gauge', 'new.counter'])
+        nt.assert_equal(metrics[1]['points'][0][1], 2)
+        nt.assert_equal(metrics[1]['tags'], ('env:prod',))
+        nt.assert_equal(stats.num_filtered_points, 0)
+
     def test_string_sets(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.set:string|s')
@@ -389,6 +556,20 @@ class TestUnitDogStatsd(unittest.TestCase):
         for p in [p95, pavg, pmed, pmax, pmin]:
             nt.assert_equal(p['points'][0][1], 5)
 
+    def test_histogram_float_subclass(self):
+        # Values of float subclasses, like numpy.float64, aren't truncated
+        class Float(float):
+            pass
+
+        stats = MetricsAggregator('myhost')
+        for value in [1, Float(1.5), Float(2.5)]:
+            stats.histogram('my.h', value)
+
+        metrics = self.sort_metrics(stats.flush())
+        p95, pavg, pcount, pmax, pmed = metrics
+        nt.assert_equal(pmax['points'][0][1], 2.5)
+        nt.assert_equal(p95['points'][0][1], 2.5)
+
     def test_batch_submission(self):
         # Submit a sampled histogram.
         stats = MetricsAggregator('myhost')
@@ -860,3 +1041,497 @@ class TestUnitDogStatsd(unittest.TestCase):
         del env["https_proxy"]
         del env["HTTP_PROXY"]
         del env["HTTPS_PROXY"]
+
+    def test_context_cache(self):
+        stats = MetricsAggregator('myhost', context_cache_size=4)
+        for i in xrange(3):
+            stats.submit_packets('cached.counter:%s|c|#tag2,host:other,tag1' % (i + 1))
+            stats.submit_packets('cached.gauge:%s.5|g|@0.5' % i)
+            stats.submit_packets('cached.set:a%s|s' % i)
+        # Packets with several values aren't cached
+        stats.submit_packets('cached.multi:1|c:2|c')
+        stats.submit_packets('cached.multi:1|c:2|c')
+        nt.assert_equal(len(stats.context_cache), 3)
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1], m['host'], m['tags']) for m in metrics], [
+            ('cached.counter', 6, 'other', ('tag1', 'tag2')),
+            ('cached.gauge', 2.5, 'myhost', None),
+            ('cached.multi', 6, 'myhost', None),
+            ('cached.set', 3, 'myhost', None),
+        ])
+
+        # Invalid values are still rejected for cached lines
+        nt.assert_raises(Exception, stats.submit_packets, 'cached.counter:x|c|#tag2,host:other,tag1')
+        nt.assert_raises(Exception, stats.submit_packets, 'cached.set:a:b|s')
+
+    def test_context_cache_eviction(self):
+        from aggregator import ContextCache
+        cache = ContextCache(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        # 'a' is promoted back to the hot generation
+        nt.assert_equal(cache.get('a'), 1)
+        cache.set('d', 4)
+        cache.set('e', 5)
+        nt.assert_equal(cache.get('a'), 1)
+        nt.assert_equal(cache.get('b'), None)
+        nt.assert_equal(cache.get('c'), None)
+
+    def test_tag_interning(self):
+        stats = MetricsAggregator('myhost', context_cache_size=0)
+        for i in xrange(10):
+            stats.submit_packets('interned.gauge.%s:1|g|#env:prod,role:web' % i)
+            stats.submit_packets('interned.gauge.%s:1|g|#role:web,env:prod' % i)
+        stats.gauge('interned.check', 1, tags=('role:web', 'env:prod'))
+
+        tag_sets = set(id(context[1]) for context in stats.metrics)
+        nt.assert_equal(len(tag_sets), 1)
+        # The unsorted tags kept by the last metric are stored once more,
+        # but not their strings
+        nt.assert_equal(len(stats.tag_sets), 2)
+        nt.assert_equal(len(stats.tag_sets.strings), 2)
+
+        # The references are counted at flush time, and don't add up
+        for _ in xrange(3):
+            stats.flush()
+            nt.assert_equal(stats.tag_sets.dedup_ratio(), 11.0)
+
+        # Expired contexts release their tags
+        stats.expiry_seconds = -1
+        stats.gauge('interned.other', 1, tags=['env:dev'])
+        stats.flush()
+        nt.assert_equal(len(stats.metrics), 0)
+        nt.assert_equal(len(stats.tag_sets), 0)
+        nt.assert_equal(stats.tag_sets.dedup_ratio(), 0)
+
+    def test_get_udp_drops(self):
+        import tempfile
+        from dogstatsd import get_udp_drops
+
+        proc_net_udp = tempfile.NamedTemporaryFile()
+        proc_net_udp.write(
+            "   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+            "  103: 0100007F:1FBD 00000000:0000 07 00000000:00000000 00:00000000 00000000   106        0 4242 2 ffff880037a8c3c0 12\n"
+            "  104: 0100007F:1FBE 00000000:0000 07 00000000:00000000 00:00000000 00000000   106        0 4343 2 ffff880037a8c780 3\n"
+        )
+        proc_net_udp.flush()
+        paths = [proc_net_udp.name, '/does/not/exist']
+
+        nt.assert_equal(get_udp_drops([4242], paths), 12)
+        nt.assert_equal(get_udp_drops([4242, 4343], paths), 15)
+        nt.assert_equal(get_udp_drops([1], paths), None)
+
+    def test_packet_ring(self):
+        from dogstatsd import PacketRing
+
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        reader.setblocking(0)
+        ring = PacketRing(4, 64)
+
+        for i in xrange(6):
+            writer.send('ring.gauge:%s|g' % i)
+        nt.assert_equal(ring.fill(reader, 3), 3)
+        nt.assert_equal(ring.fill(reader, 10), 3)
+        nt.assert_equal(ring.overflow_count, 2)
+        nt.assert_equal(ring.high_water, 4)
+        nt.assert_equal(ring.drain(0), ['ring.gauge:%s|g' % i for i in xrange(4)])
+
+        # Slots are reused once drained
+        writer.send('ring.gauge:6|g')
+        nt.assert_equal(ring.fill(reader, 10), 1)
+        nt.assert_equal(ring.drain(0), ['ring.gauge:6|g'])
+        nt.assert_equal(ring.drain(0), [])
+        reader.close()
+        writer.close()
+
+
+@attr(requires='core_integration')
+class TestDogstatsdServer(unittest.TestCase):
+    PORT = 8129
+
+    def start_server(self, server):
+        import dogstatsd
+        self._timeout = dogstatsd.UDP_SOCKET_TIMEOUT
+        dogstatsd.UDP_SOCKET_TIMEOUT = 0.1
+
+        self.server = server
+        self.thread = threading.Thread(target=server.start)
+        self.thread.start()
+        while not server.running:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        import dogstatsd
+        self.server.stop()
+        self.thread.join()
+        dogstatsd.UDP_SOCKET_TIMEOUT = self._timeout
+
+    def send(self, packets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for packet in packets:
+            sock.sendto(packet, ('127.0.0.1', self.PORT))
+        sock.close()
+
+    def wait_for_packets(self, stats, count):
+        for _ in xrange(100):
+            if stats.count >= count:
+                break
+            time.sleep(0.05)
+
+    def test_batched_recv(self):
+        from dogstatsd import Server
+        stats = MetricsAggregator('myhost')
+        self.start_server(Server(stats, '127.0.0.1', self.PORT, recv_batch_size=8))
+
+        self.send(['batch.counter:1|c'] * 50)
+        self.wait_for_packets(stats, 50)
+
+        nt.assert_equal(self.server.datagram_count, 50)
+        assert 7 <= self.server.wakeup_count <= 50
+        recv_stats = self.server.recv_stats()
+        nt.assert_equal(recv_stats['datagrams'], 50)
+        nt.assert_equal(recv_stats['wakeups'], self.server.wakeup_count)
+        nt.assert_equal(self.server.recv_stats()['datagrams'], 0)
+
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 50)
+
+    def check_malformed_datagram(self, **kwargs):
+        from dogstatsd import Server
+        stats = MetricsAggregator('myhost')
+        self.start_server(Server(stats, '127.0.0.1', self.PORT, recv_batch_size=8, **kwargs))
+
+        # A malformed datagram doesn't lose the rest of its batch
+        self.send(['good.a:1|c', 'bad:x|c', 'good.b:1|c', 'good.c:1|c'])
+        self.wait_for_packets(stats, 4)
+        # The count goes up before the packet is parsed
+        time.sleep(0.1)
+
+        metrics = stats.flush()
+        nt.assert_equal(sorted(m['metric'] for m in metrics), ['good.a', 'good.b', 'good.c'])
+
+    def test_malformed_datagram(self):
+        self.check_malformed_datagram()
+
+    def test_malformed_datagram_ring(self):
+        self.check_malformed_datagram(ring_slots=16)
+
+    def test_ring_buffer(self):
+        from dogstatsd import Server
+        stats = MetricsAggregator('myhost')
+        self.start_server(Server(stats, '127.0.0.1', self.PORT, recv_batch_size=8, ring_slots=16))
+
+        self.send(['ring.counter:1|c'] * 10)
+        self.wait_for_packets(stats, 10)
+
+        recv_stats = self.server.recv_stats()
+        nt.assert_equal(recv_stats['datagrams'], 10)
+        nt.assert_equal(recv_stats['ring_slots'], 16)
+        nt.assert_equal(recv_stats['ring_overflow'], 0)
+        assert 1 <= recv_stats['ring_high_water'] <= 10
+
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 10)
+
+    def test_top_sources(self):
+        from dogstatsd import Server
+        stats = MetricsAggregator('myhost')
+        self.start_server(Server(stats, '127.0.0.1', self.PORT, recv_batch_size=8, top_k=2))
+
+        # From several client sockets, counted by host
+        self.send(['top.counter:1|c'] * 5)
+        self.send(['top.counter:1|c'] * 5)
+        self.wait_for_packets(stats, 10)
+
+        top_sources = self.server.recv_stats()['top_sources']
+        nt.assert_equal(top_sources, [('127.0.0.1', 10)])
+        nt.assert_equal(self.server.recv_stats()['top_sources'], [])
+
+    def test_flush_aggregator(self):
+        import os
+        import tempfile
+        from aggregator import MetricsBucketAggregator
+        from dogstatsd import Server
+
+        # Unix sockets don't drop datagrams, the sender waits instead
+        socket_path = os.path.join(tempfile.mkdtemp(), 'dogstatsd.sock')
+        stats = MetricsBucketAggregator('myhost', interval=1)
+        self.start_server(Server(MetricsBucketAggregator('myhost', interval=1), '127.0.0.1', self.PORT,
+                                 recv_batch_size=16, socket_path=socket_path, flush_aggregator=stats))
+
+        def send():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.connect(socket_path)
+            for i in xrange(2000):
+                sock.send('swapped.counter:1|c|#tag:%s' % (i % 10))
+            sock.close()
+
+        # Flush continuously while packets come in
+        points = []
+        sender = threading.Thread(target=send)
+        sender.start()
+        while sender.is_alive():
+            self.server.collect()
+            points += stats.flush()
+        sender.join()
+
+        for _ in xrange(100):
+            self.server.collect()
+            if stats.count + stats.total_count >= 2000:
+                break
+            time.sleep(0.05)
+        time.sleep(1)
+        self.server.collect()
+        points += stats.flush()
+
+        nt.assert_equal(stats.total_count, 2000)
+        nt.assert_equal(sum(p['points'][0][1] for p in points if p['metric'] == 'swapped.counter'), 2000)
+        # The server's aggregator only holds what came since the last swap
+        nt.assert_equal(self.server.metrics_aggregator.metric_by_bucket, {})
+
+    def test_sharded_server(self):
+        from aggregator import MetricsBucketAggregator
+        from dogstatsd import ShardedServer
+
+        def aggregator_factory():
+            return MetricsBucketAggregator('myhost', interval=1)
+
+        stats = aggregator_factory()
+        self.start_server(ShardedServer(stats, aggregator_factory, 2, '127.0.0.1', self.PORT))
+        # Let the workers bind the port
+        time.sleep(0.5)
+
+        self.send(['sharded.counter:1|c|#tag:%s' % (i % 2) for i in xrange(100)])
+        for _ in xrange(100):
+            self.server.collect()
+            if stats.count >= 100:
+                break
+            time.sleep(0.05)
+        nt.assert_equal(stats.count, 100)
+
+        time.sleep(1)
+        metrics = [m for m in stats.flush() if m['metric'] == 'sharded.counter']
+        nt.assert_equal(len(metrics), 2)
+        nt.assert_equal(sorted(m['points'][0][1] for m in metrics), [50, 50])
+
+    def test_unix_socket(self):
+        import os
+        import tempfile
+        from dogstatsd import Server
+
+        socket_path = os.path.join(tempfile.mkdtemp(), 'dogstatsd.sock')
+        stats = MetricsAggregator('myhost')
+        self.start_server(Server(stats, '127.0.0.1', self.PORT, socket_path=socket_path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.connect(socket_path)
+        sock.send('unix.gauge:1|g')
+        sock.send('unix.counter:1|c\nunix.counter:2|c')
+        sock.close()
+        self.send(['unix.counter:3|c'])
+        self.wait_for_packets(stats, 4)
+
+        metrics = TestUnitDogStatsd.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                        [('unix.counter', 6), ('unix.gauge', 1)])
+
+        self.server.stop()
+        self.thread.join()
+        assert not os.path.exists(socket_path)
+
+        # Anything else than a socket is left alone
+        Server._remove_socket_file(socket_path)
+        open(socket_path, 'w').close()
+        nt.assert_raises(OSError, Server._remove_socket_file, socket_path)
+        assert os.path.isfile(socket_path)
+
+    def test_rcvbuf_and_drops(self):
+        from dogstatsd import Server
+        stats = MetricsAggregator('myhost')
+        self.start_server(Server(stats, '127.0.0.1', self.PORT, so_rcvbuf=65536))
+
+        assert self.server.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+        if sys.platform.startswith('linux'):
+            nt.assert_equal(self.server.dropped_packets(), 0)
+
+        # Linux reports twice the size set, up to twice net.core.rmem_max
+        sock = mock.Mock()
+        with mock.patch.object(sys, 'platform', 'linux2'):
+            with mock.patch('dogstatsd.log') as log:
+                sock.getsockopt.return_value = 131072
+                Server._set_rcvbuf(sock, 65536)
+                nt.assert_equal(log.warning.call_count, 0)
+                sock.getsockopt.return_value = 65536
+                Server._set_rcvbuf(sock, 65536)
+                nt.assert_equal(log.warning.call_count, 1)
+
+    def test_drops_unavailable(self):
+        from dogstatsd import Server
+        stats = MetricsAggregator('myhost')
+        # The socket isn't a file descriptor on Windows
+        with mock.patch.object(sys, 'platform', 'win32'):
+            with mock.patch('os.fstat', side_effect=OSError(9, 'Bad file descriptor')):
+                self.start_server(Server(stats, '127.0.0.1', self.PORT))
+        nt.assert_equal(self.server.dropped_packets(), None)
+
+
+class TestShardedServer(unittest.TestCase):
+
+    def test_late_reply(self):
+        import multiprocessing
+        from aggregator import MetricsBucketAggregator
+        from dogstatsd import ShardedServer
+
+        stats = MetricsBucketAggregator('myhost', interval=1)
+        server = ShardedServer(stats, None, 1, '127.0.0.1', 8129)
+        worker = mock.Mock()
+        worker.is_alive.return_value = True
+        parent_conn, child_conn = multiprocessing.Pipe()
+        server.workers = [(worker, parent_conn)]
+
+        late = MetricsBucketAggregator('myhost', interval=1)
+        late.submit_packets('late.counter:1|c')
+        current = MetricsBucketAggregator('myhost', interval=1)
+        current.submit_packets('current.counter:1|c')
+
+        # The reply to the previous request comes in before the current one
+        child_conn.send((0, late.export_state(), {}))
+        child_conn.send((1, current.export_state(), {}))
+        server.collect()
+        nt.assert_equal(child_conn.recv(), ('flush', 1))
+        nt.assert_equal(stats.count, 1)
+        nt.assert_equal([context[0] for m in stats.metric_by_bucket.values() for context in m],
+                        ['current.counter'])
+
+
+class TestPayloadSender(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.spill_dir = tempfile.mkdtemp()
+        self.posted = []
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.spill_dir)
+
+    def post(self, url, data, headers):
+        self.posted.append(data)
+        return True
+
+    def test_retries(self):
+        from dogstatsd import PayloadSender
+
+        outcomes = [False, False]
+        def post(url, data, headers):
+            if outcomes:
+                return outcomes.pop()
+            return self.post(url, data, headers)
+
+        sender = PayloadSender()
+        with mock.patch('dogstatsd.post_payload', post), mock.patch('dogstatsd.SENDER_MIN_RETRY_DELAY', 0.01):
+            sender.start()
+            for i in xrange(3):
+                sender.enqueue('http://intake', 'payload-%s' % i, {})
+            for _ in xrange(100):
+                if len(self.posted) == 3:
+                    break
+                time.sleep(0.05)
+            sender.stop()
+            sender.join()
+
+        nt.assert_equal(self.posted, ['payload-0', 'payload-1', 'payload-2'])
+        nt.assert_equal(sender.stats()['sent'], 3)
+
+    def test_post_payload(self):
+        from dogstatsd import post_payload
+        import requests
+
+        def response(status_code):
+            r = requests.Response()
+            r.status_code = status_code
+            return r
+
+        sessions = mock.Mock()
+        with mock.patch('dogstatsd.get_http_sessions', return_value=sessions):
+            for status_code, done in [(202, True), (500, False), (503, False), (408, False),
+                                      (429, False), (400, True), (403, True)]:
+                sessions.post.return_value = response(status_code)
+                nt.assert_equal(post_payload('http://intake', 'payload', {}), done, status_code)
+
+            # Network errors are worth retrying
+            sessions.post.side_effect = requests.ConnectionError()
+            nt.assert_false(post_payload('http://intake', 'payload', {}))
+
+    def test_bounded_queue(self):
+        from dogstatsd import PayloadSender
+
+        sender = PayloadSender(max_queue_size=20)
+        for i in xrange(5):
+            sender.enqueue('http://intake', 'payload-%s' % i, {})
+        nt.assert_equal(list(data for _, _, data, _ in sender.queue), ['payload-3', 'payload-4'])
+        nt.assert_equal(sender.stats()['dropped'], 3)
+
+    def test_spill(self):
+        from dogstatsd import PayloadSender
+
+        sender = PayloadSender(max_queue_size=20, spill_dir=self.spill_dir)
+        for i in xrange(5):
+            sender.enqueue('http://intake', 'payload-%s' % i, {'Content-Type': 'application/json'})
+        nt.assert_equal(sender.stats()['spilled'], 3)
+
+        # Stopping spills the rest, picked up by the next sender
+        with mock.patch('dogstatsd.post_payload', lambda *args: False):
+            sender.start()
+            sender.stop()
+            sender.join()
+        sender = PayloadSender(spill_dir=self.spill_dir)
+        nt.assert_equal(sender.stats()['spilled'], 5)
+
+        with mock.patch('dogstatsd.post_payload', self.post):
+            sender.start()
+            for _ in xrange(100):
+                if len(self.posted) == 5:
+                    break
+                time.sleep(0.05)
+            sender.stop()
+            sender.join()
+        nt.assert_equal(self.posted, ['payload-%s' % i for i in xrange(5)])
+        nt.assert_equal(sender.stats()['spilled'], 0)
+        import os
+        nt.assert_equal(os.listdir(self.spill_dir), [])
+
+    def test_spill_order(self):
+        from dogstatsd import PayloadSender
+
+        sender = PayloadSender(max_queue_size=20, spill_dir=self.spill_dir)
+        for i in xrange(5):
+            sender.enqueue('http://intake', 'payload-%s' % i, {})
+        nt.assert_equal(sender.stats()['spilled'], 3)
+
+        # A payload queued in memory once there is room again waits for the
+        # older spilled ones
+        posting = threading.Event()
+        resume = threading.Event()
+        def post(url, data, headers):
+            posting.set()
+            resume.wait(5)
+            return self.post(url, data, headers)
+
+        with mock.patch('dogstatsd.post_payload', post):
+            sender.start()
+            posting.wait(5)
+            sender.enqueue('http://intake', 'payload-5', {})
+            nt.assert_equal(sender.stats()['queued'], 2)
+            resume.set()
+            for _ in xrange(100):
+                if len(self.posted) == 6:
+                    break
+                time.sleep(0.05)
+            sender.stop()
+            sender.join()
+        nt.assert_equal(self.posted, ['payload-%s' % i for i in xrange(6)])
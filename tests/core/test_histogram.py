@@ -1,7 +1,12 @@
+import random
 import unittest
 
-from aggregator import MetricsAggregator, Histogram
+import mock
+
+import aggregator
+from aggregator import MetricsAggregator, MetricsBucketAggregator, Histogram, SketchHistogram
 from config import get_histogram_aggregates, get_histogram_percentiles
+from utils.sketches import QuantileSketch
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -141,3 +146,122 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['median'], 9, value_by_type)
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_sketch(self):
+        stats = MetricsAggregator('myhost', histogram_sketch=True,
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, count'),
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.95, 0.99')
+        )
+
+        values = range(1, 1001) * 3
+        random.shuffle(values)
+        for value in values:
+            stats.submit_packets('myhistogram:{0}|ms'.format(value))
+        stats.submit_packets('myhistogram:1|ms|@0.5')
+
+        self.assertTrue(isinstance(stats.metrics.values()[0], SketchHistogram))
+        # Bounded by the number of distinct values within the relative accuracy
+        self.assertTrue(len(stats.metrics.values()[0].samples.positive) < 400)
+
+        metrics = stats.flush()
+        value_by_type = {}
+        for k in metrics:
+            value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+
+        self.assertEquals(value_by_type['min'], 1, value_by_type)
+        self.assertEquals(value_by_type['max'], 1000, value_by_type)
+        self.assertAlmostEqual(value_by_type['avg'], 1501501 / 3001.0)
+        self.assertEquals(value_by_type['count'], 3002, value_by_type)
+        for name, expected in [('median', 500), ('50percentile', 500),
+                               ('95percentile', 950), ('99percentile', 990)]:
+            self.assertTrue(abs(value_by_type[name] - expected) <= 0.01 * expected + 1, value_by_type)
+
+        # Sketches are reset on flush
+        self.assertEquals(stats.flush(), [])
+
+    def test_sketch_merge(self):
+        def aggregator():
+            return MetricsBucketAggregator('myhost', interval=1, histogram_sketch=True)
+
+        stats = aggregator()
+        for shard in xrange(2):
+            worker = aggregator()
+            for i in xrange(shard, 100, 2):
+                worker.submit_packets('myhistogram:{0}|h'.format(i - 50))
+            stats.merge_state(worker.export_state())
+
+        sketch = stats.metric_by_bucket.values()[0].values()[0].samples
+        expected = QuantileSketch()
+        for i in xrange(100):
+            expected.add(i - 50)
+        self.assertEquals(sketch.count, 100)
+        self.assertEquals((sketch.min, sketch.max, sketch.sum), (-50, 49, -50))
+        self.assertEquals(sketch.negative, expected.negative)
+        self.assertEquals(sketch.positive, expected.positive)
+        self.assertEquals(sketch.zero_count, 1)
+        for rank in (0, 10, 50, 94, 99):
+            self.assertEquals(sketch.value_at_rank(rank), expected.value_at_rank(rank))
+        self.assertTrue(abs(sketch.value_at_rank(10) + 40) <= 0.4)
+
+    def test_sketch_max_bins(self):
+        sketch = QuantileSketch(max_bins=10)
+        for i in xrange(1, 101):
+            sketch.add(i)
+        self.assertEquals(len(sketch.positive), 10)
+        self.assertEquals(sketch.count, 100)
+        self.assertEquals(sum(sketch.positive.values()), 100)
+        # The highest ranks are kept accurate
+        self.assertTrue(abs(sketch.value_at_rank(98) - 99) <= 1)
+
+    def check_flush_compatibility(self):
+        percentiles = [0.05, 0.5, 0.75, 0.95, 0.99]
+        aggregates = ['min', 'max', 'median', 'avg', 'count']
+
+        def expected(samples):
+            # Aggregates as computed from the sorted list of samples
+            samples = sorted(samples)
+            length = len(samples)
+            values = {
+                'min': samples[0],
+                'max': samples[-1],
+                'median': samples[int(round(length/2 - 1))],
+                'avg': sum(samples) / float(length),
+                'count': float(length),
+            }
+            for p in percentiles:
+                values['%spercentile' % int(p * 100)] = samples[int(round(p * length - 1))]
+            return values
+
+        class Float(float):
+            pass
+
+        for samples in [[7], [3, 1], range(20), [random.randint(-1000, 1000) for _ in xrange(1001)],
+                        [random.random() * 1000 for _ in xrange(999)],
+                        [1, 2.5, 3, 0.5, 10], [2 ** 60 + 1, 2 ** 60, 3], [2 ** 70, -5, 2],
+                        [1.0, 1, 2, 2.0], [Float(1.5), 3, 2.5], [True, 2, 3]]:
+            stats = MetricsAggregator('myhost', histogram_aggregates=aggregates,
+                                      histogram_percentiles=percentiles)
+            # Some samples come from merged histograms
+            other = MetricsAggregator('myhost', histogram_aggregates=aggregates,
+                                      histogram_percentiles=percentiles)
+            for i, value in enumerate(samples):
+                (other if i % 3 == 2 else stats).histogram('myhistogram', value)
+            for context, metric in other.metrics.iteritems():
+                stats.metrics[context].merge(metric)
+
+            value_by_type = {}
+            for k in stats.flush():
+                value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+
+            merged = [value for i, value in enumerate(samples) if i % 3 != 2] + samples[2::3]
+            for name, value in expected(merged).iteritems():
+                self.assertEquals(repr(value_by_type[name]), repr(value), (name, samples))
+
+    def test_flush_compatibility(self):
+        with mock.patch.object(aggregator, 'numpy', None):
+            self.check_flush_compatibility()
+
+    def test_flush_compatibility_numpy(self):
+        if aggregator.numpy is None:
+            raise unittest.SkipTest("numpy isn't installed")
+        self.check_flush_compatibility()
@@ -0,0 +1,100 @@
+# stdlib
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# project
+from util import HTTPSessionPool
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Keep-alive connections hold a thread each
+    daemon_threads = True
+
+
+class TestHTTPSessionPool(unittest.TestCase):
+    def setUp(self):
+        test = self
+        self.requested = threading.Event()
+        self.release = threading.Event()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path == '/slow':
+                    test.requested.set()
+                    test.release.wait(5)
+                body = self.headers.get('Cookie') or 'no cookie'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Set-Cookie', 'session=1')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def testKeepAlive(self):
+        pool = HTTPSessionPool()
+        for _ in xrange(3):
+            r = pool.get(self.url)
+            self.assertEquals(r.text, 'no cookie')
+        self.assertTrue(pool.session(self.url) is pool.session(self.url.upper()))
+
+        stats = pool.stats()
+        self.assertEquals(stats['sessions'], 1)
+        self.assertEquals(stats['requests'], 3)
+        self.assertEquals(stats['connections'], 1)
+        self.assertEquals(stats['reused'], 2)
+        pool.close()
+        self.assertEquals(pool.stats(), {'sessions': 0, 'requests': 3, 'connections': 1, 'reused': 2})
+
+    def testIdleEviction(self):
+        pool = HTTPSessionPool(idle_timeout=-1)
+        session = pool.session(self.url)
+        session.get(self.url)
+        self.assertFalse(pool.session(self.url) is session)
+        stats = pool.stats()
+        self.assertEquals(stats['sessions'], 1)
+        self.assertEquals(stats['requests'], 1)
+
+    def testNoEvictionInUse(self):
+        """ A session isn't closed while a request is in progress on it """
+        pool = HTTPSessionPool(idle_timeout=-1)
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(pool.get(self.url + 'slow')))
+        thread.start()
+        self.requested.wait(5)
+        session = pool.session(self.url)
+        self.assertTrue(pool.session(self.url) is session)
+        self.release.set()
+        thread.join()
+        self.assertEquals(responses[0].status_code, 200)
+
+        # Evicted once the request is over
+        self.assertFalse(pool.session(self.url) is session)
+        pool.close()
+
+    def testTLSSettings(self):
+        """ Connections aren't shared by requests with different TLS settings """
+        pool = HTTPSessionPool()
+        session = pool.session(self.url)
+        self.assertTrue(pool.session(self.url, verify=True) is session)
+        self.assertFalse(pool.session(self.url, verify=False) is session)
+        self.assertFalse(pool.session(self.url, cert='/etc/client.pem') is session)
+        pool.get(self.url, verify=False)
+        pool.get(self.url)
+        self.assertEquals(pool.stats()['connections'], 2)
+        pool.close()
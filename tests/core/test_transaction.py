@@ -1,8 +1,14 @@
 # stdlib
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+import zlib
 from datetime import timedelta, datetime
 
 # 3rd party
+import mock
 from nose.plugins.attrib import attr
 from tornado.web import Application
 import requests
@@ -12,9 +18,11 @@ import simplejson as json
 from transaction import Transaction, TransactionManager
 from ddagent import (
     MAX_QUEUE_SIZE, THROTTLING_DELAY,
-    APIMetricTransaction, APIServiceCheckTransaction, MetricTransaction
+    AgentTransaction, APIMetricTransaction, APIServiceCheckTransaction, MetricTransaction
     )
+import ddagent
 from config import get_version
+from utils.segment_store import SegmentStore
 
 
 class memTransaction(Transaction):
@@ -36,6 +44,57 @@ class memTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class pendingTransaction(memTransaction):
+    """ A transaction whose response comes when `respond` is called. """
+    def flush(self):
+        self._flush_count = self._flush_count + 1
+
+    def respond(self):
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
+class storedTransaction(memTransaction):
+    """ A transaction with data, that can be written to a disk queue. """
+    def __init__(self, data, manager):
+        self._data = data
+        memTransaction.__init__(self, len(data), manager)
+
+    def serialize(self):
+        return self._data
+
+    def has_data(self):
+        return self._data is not None
+
+    def drop_data(self):
+        self._data = None
+
+    def load_data(self, record):
+        self._data = record
+
+
+class batchTransaction(pendingTransaction):
+    """ A transaction that can be sent along with others of the same key. """
+    def __init__(self, size, manager, key, batch_size=None):
+        pendingTransaction.__init__(self, size, manager)
+        self._key = key
+        self._batch_size = batch_size
+        self.batch = None
+
+    def get_coalesce_key(self):
+        return self._key
+
+    def get_batch_size(self):
+        if self._batch_size is None:
+            return self.get_data_size()
+        return self._batch_size
+
+    def flush_batch(self, batch):
+        self.batch = batch
+        for tr in batch:
+            tr._flush_count += 1
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -58,8 +117,8 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list, with
         # a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count,1)
 
         # Try to add one more
@@ -67,14 +126,14 @@ class TestTransaction(unittest.TestCase):
         trManager.append(tr)
 
         # At this point, transaction one (the oldest) should have been removed from the list
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id,1)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -83,7 +142,300 @@ class TestTransaction(unittest.TestCase):
                 self.assertEqual(tr._flush_count,2)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
+
+    def testReplayDelay(self):
+        """Test that transactions in error are only replayed when due, and evicted first"""
+
+        trManager = TransactionManager(timedelta(seconds=100), MAX_QUEUE_SIZE, timedelta(seconds=0))
+
+        oneTrSize = MAX_QUEUE_SIZE / 4
+        trs = [memTransaction(oneTrSize, trManager) for _ in xrange(3)]
+        for tr in trs:
+            trManager.append(tr)
+        trs[0].is_flushable = True
+
+        trManager.flush()
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [2, 3])
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1, 1])
+
+        # Not due yet
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1, 1])
+
+        # The transaction replayed last goes first when the queue is full
+        trManager.tr_error(trs[2])
+        trManager.append(memTransaction(oneTrSize * 2 + 1, trManager))
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [2, 4])
+        self.assertEqual(trManager._total_count, 2)
+        self.assertEqual(trManager._total_size, oneTrSize * 3 + 1)
+
+        trManager.flush()
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [2, 4])
+        self.assertEqual(trs[1]._flush_count, 1)
+
+    def testConcurrentFlush(self):
+        """Test that up to max_in_flight transactions wait for a response at once"""
+
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=2)
+        trs = [pendingTransaction(10, trManager) for _ in xrange(3)]
+        for tr in trs:
+            trManager.append(tr)
+
+        # The last due transactions are sent first
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [0, 1, 1])
+        self.assertEqual(len(trManager._in_flight), 2)
+
+        # A flush is in progress
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [0, 1, 1])
+
+        trs[2].respond()
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1, 1])
+        trs[1].respond()
+        trs[0].respond()
+        self.assertEqual(trManager.get_transactions(), [])
+        self.assertTrue(trManager._trs_to_flush is None)
+
+    def testSegmentStore(self):
+        """Test that only the records not acknowledged are replayed, within the disk budget"""
+        path = tempfile.mkdtemp()
+        try:
+            store = SegmentStore(path, 4000, segment_size=1000)
+            locations = [store.append(str(i) * 300)[0] for i in xrange(6)]
+            self.assertEqual(store.read(locations[4]), '4' * 300)
+            store.discard(locations[1])
+            store.discard(locations[4])
+            store.close()
+
+            store = SegmentStore(path, 4000, segment_size=1000)
+            self.assertEqual([record for _, record in store.replay()],
+                             [str(i) * 300 for i in (0, 2, 3, 5)])
+
+            # The oldest segment goes first when the budget is exceeded
+            dropped = []
+            for i in xrange(10):
+                dropped += store.append('x' * 300)[1]
+            self.assertTrue(store.size() <= 4000)
+            self.assertEqual(sorted(dropped)[:2], [locations[0], locations[2]])
+            store.close()
+        finally:
+            shutil.rmtree(path)
+
+        # A truncated segment is read up to its last complete record
+        path = tempfile.mkdtemp()
+        try:
+            store = SegmentStore(path, 4000, segment_size=1000)
+            store.append('a' * 100)
+            store.append('b' * 100)
+            store.close()
+            segment = os.path.join(path, os.listdir(path)[0])
+            with open(segment, 'r+b') as f:
+                f.truncate(os.path.getsize(segment) - 10)
+            store = SegmentStore(path, 4000, segment_size=1000)
+            self.assertEqual([record for _, record in store.replay()], ['a' * 100])
+            store.close()
+        finally:
+            shutil.rmtree(path)
+
+    def testDiskQueue(self):
+        """Test that queued transactions are replayed after a restart, with their data on disk only"""
+        path = tempfile.mkdtemp()
+        try:
+            trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                           store=SegmentStore(path, 100000), max_memory_size=250)
+            trs = [storedTransaction(str(i) * 100, trManager) for i in xrange(4)]
+            for tr in trs:
+                trManager.append(tr)
+            trs[1].is_flushable = True
+            trManager.flush()
+
+            # Past the memory budget, the data of the oldest transactions is on disk only
+            self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [1, 3, 4])
+            self.assertEqual([tr.has_data() for tr in trManager.get_transactions()], [False, True, True])
+            self.assertTrue(trManager._memory_size <= 250)
+
+            trManager.flush()
+            self.assertEqual([tr._flush_count for tr in trs], [2, 1, 2, 2])
+            trManager.close()
+
+            trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                           store=SegmentStore(path, 100000))
+            loaded = []
+            def loader(record):
+                tr = storedTransaction(record, trManager)
+                loaded.append(tr)
+                return tr
+            trManager.replay(loader)
+            self.assertEqual([tr._data for tr in loaded], ['0' * 100, '2' * 100, '3' * 100])
+
+            for tr in loaded:
+                tr.is_flushable = True
+            trManager.flush()
+            self.assertEqual(trManager.get_transactions(), [])
+            trManager.close()
+
+            trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                           store=SegmentStore(path, 100000))
+            trManager.replay(loader)
+            self.assertEqual(trManager.get_transactions(), [])
+        finally:
+            shutil.rmtree(path)
+
+    def testDiskQueueFailure(self):
+        """Test that the queue is bounded in memory when the store can't be written"""
+        store = mock.Mock()
+        store.append.side_effect = IOError("No space left on device")
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0), store=store)
+
+        oneTrSize = MAX_QUEUE_SIZE / 4
+        for i in xrange(5):
+            trManager.append(storedTransaction('x' * oneTrSize, trManager))
+        self.assertEqual(len(trManager.get_transactions()), 4)
+        self.assertTrue(trManager._memory_size <= MAX_QUEUE_SIZE)
+
+    def testSizeAccounting(self):
+        """Test that the queue size covers the transactions metadata, by transaction type"""
+
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        trs = [memTransaction(100, trManager), memTransaction(200, trManager), pendingTransaction(50, trManager)]
+        for tr in trs:
+            trManager.append(tr)
+        self.assertEqual(trManager._size_by_type, {'memTransaction': [2, 300], 'pendingTransaction': [1, 50]})
+
+        trManager.tr_success(trs[0])
+        trManager.tr_success(trs[2])
+        self.assertEqual(trManager._size_by_type, {'memTransaction': [1, 200]})
+        self.assertEqual(trManager._total_size, 200)
+
+        # Headers are counted along with the payload
+        MetricTransaction._endpoints = []
+        MetricTransaction._trManager = trManager
+        data = 'x' * 1000
+        tr = MetricTransaction(data, {})
+        size = tr.get_size()
+        self.assertEqual(tr.get_data_size(), sys.getsizeof(data))
+        self.assertTrue(size > tr.get_data_size())
+        tr_with_headers = MetricTransaction(data, {'Content-Type': 'y' * 500})
+        self.assertTrue(tr_with_headers.get_size() > size + 500)
+        self.assertEqual(trManager._size_by_type['MetricTransaction'], [2, size + tr_with_headers.get_size()])
+
+    def testCoalescing(self):
+        """Test that due transactions with the same key are sent together, up to the batch size"""
+
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=10, max_batch_size=250)
+        trs = [batchTransaction(100, trManager, 'series') for _ in xrange(3)]
+        trs.append(batchTransaction(100, trManager, 'check_run'))
+        trs.append(memTransaction(100, trManager))
+        for tr in trs:
+            trManager.append(tr)
+
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1, 1, 1, 1])
+        self.assertEqual(len(trManager._in_flight), 4)
+        self.assertEqual(trs[2].batch, [trs[2], trs[1]])
+        self.assertEqual(trs[0].batch, None)
+
+        # The whole batch succeeds
+        for tr in trs[1:3]:
+            trManager.tr_success(tr)
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [1, 4, 5])
+        self.assertEqual(trManager._requests_in_flight, 2)
+
+        # Bounded by the uncompressed payload size
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=10, max_batch_size=250)
+        trs = [batchTransaction(100, trManager, 'series', batch_size=200) for _ in xrange(2)]
+        for tr in trs:
+            trManager.append(tr)
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1])
+        self.assertEqual([tr.batch for tr in trs], [None, None])
+
+    def testConcurrentBatches(self):
+        """Test that max_in_flight bounds the requests, not the transactions sent in them"""
+
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_in_flight=2, max_batch_size=1000)
+        trs = [batchTransaction(100, trManager, 'series') for _ in xrange(4)]
+        trs += [batchTransaction(100, trManager, 'check_run') for _ in xrange(4)]
+        trs.append(pendingTransaction(100, trManager))
+        for tr in trs:
+            trManager.append(tr)
+
+        # A batch of 4 transactions takes one request
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [0, 0, 0, 0, 1, 1, 1, 1, 1])
+        self.assertEqual(len(trManager._in_flight), 5)
+        self.assertEqual(trManager._requests_in_flight, 2)
+
+        # Two batches at once
+        trs[8].respond()
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertEqual(len(trManager._in_flight), 8)
+        self.assertEqual(trManager._requests_in_flight, 2)
+
+        for tr in trs[:8]:
+            trManager.tr_success(tr)
+        self.assertEqual(trManager._requests_in_flight, 0)
+        self.assertEqual(trManager.get_transactions(), [])
+
+    def testBatchPayload(self):
+        """Test that series and service checks payloads are merged and compressed once"""
+        MetricTransaction._endpoints = []
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        APIMetricTransaction._trManager = trManager
+        APIServiceCheckTransaction._trManager = trManager
+
+        series = [{'metric': 'a', 'points': [[1, 1]]}, {'metric': 'b', 'points': [[1, 2]]}]
+        trs = [APIMetricTransaction(json.dumps({'series': series[:1]}), {'Content-Type': 'application/json'}),
+               APIMetricTransaction(zlib.compress(json.dumps({'series': series[1:]})),
+                                    {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}),
+               APIMetricTransaction('not json', {'Content-Type': 'application/json'})]
+
+        with mock.patch.object(APIMetricTransaction, '_post') as post:
+            trs[0].flush_batch(trs)
+        self.assertEqual(post.call_count, 2)
+        # The invalid payload is sent on its own
+        self.assertEqual(post.call_args_list[0][0][0], 'not json')
+        data, headers, callback = post.call_args_list[1][0]
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(data)), {'series': series})
+        self.assertEqual(callback.args, (trs[:2],))
+        self.assertEqual(trs[1].get_batch_size(), len(json.dumps({'series': series[1:]})))
+
+        checks = [{'check': 'a', 'status': 0}, {'check': 'b', 'status': 1}]
+        tr = APIServiceCheckTransaction(json.dumps(checks), {'Content-Type': 'application/json'})
+        self.assertEqual(tr.get_batch_items(), checks)
+
+    def testHTTPClient(self):
+        """Test that the HTTP client is configured once, with the requests settings as defaults"""
+        MetricTransaction._endpoints = AgentTransaction._endpoints = []
+        config = {
+            "dd_url": "https://foo.bar.com",
+            "api_key": "foo",
+            "use_dd": True,
+            "forwarder_max_in_flight": "3",
+        }
+        app = ddagent.Application(17123, config, watchdog=False, skip_ssl_validation=True)
+        MetricTransaction.set_application(app)
+        client = AgentTransaction.get_http_client()
+        self.assertEqual(client.max_clients, 3)
+        self.assertFalse(client.defaults['validate_cert'])
+
+        tr = APIMetricTransaction('{"series": []}', {'Content-Type': 'application/json', 'Content-Length': '15'})
+        with mock.patch.object(client, 'fetch') as fetch:
+            tr.flush()
+            tr.flush()
+        self.assertEqual(fetch.call_count, 2)
+        request = fetch.call_args[0][0]
+        self.assertEqual(request.url, 'https://foo.bar.com/api/v1/series/?api_key=foo')
+        self.assertFalse('Content-Length' in request.headers)
+        self.assertEqual(AgentTransaction._endpoint_urls.keys(), [(APIMetricTransaction, 'dd_url')])
+        MetricTransaction._endpoints = AgentTransaction._endpoints = []
 
     def testThrottling(self):
         """Test throttling while flushing"""
@@ -2,8 +2,8 @@
 import sys
 import time
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
 
 # project
 from checks.check_status import ForwarderStatus
@@ -13,6 +13,11 @@ log = logging.getLogger(__name__)
 
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
+# Seconds between two fsyncs of the disk queue
+STORE_SYNC_INTERVAL = 1
+# Stale heap entries tolerated, over the number of transactions, before the
+# heaps get rebuilt
+HEAP_COMPACTION_SLACK = 64
 
 class Transaction(object):
 
@@ -37,11 +42,24 @@ class Transaction(object):
         return self._error_count 
 
     def get_size(self):
+        """ Bytes taken by the transaction, payload and metadata. """
         if self._size is None:
             self._size = sys.getsizeof(self)
 
         return self._size
 
+    def get_data_size(self):
+        """ Bytes of `get_size` taken by the payload, that a disk queue can
+        drop from memory. """
+        return self.get_size()
+
+    def get_batch_size(self):
+        """ Size of the payload once merged with others by `flush_batch`. """
+        return self.get_data_size()
+
+    def get_type(self):
+        return self.__class__.__name__
+
     def get_next_flush(self):
         return self._next_flush
 
@@ -58,23 +76,90 @@ class Transaction(object):
     def time_to_flush(self,now = datetime.now()):
         return self._next_flush < now
 
+    def get_flush_key(self):
+        """ The next flush time, in seconds. """
+        return time.mktime(self._next_flush.timetuple()) + self._next_flush.microsecond / 1e6
+
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+    # Disk queue support: a transaction is written as a record, and its data
+    # may be dropped from memory and loaded back from the record before it
+    # is flushed.
+    def serialize(self):
+        raise NotImplementedError("To be implemented in a subclass")
+
+    def has_data(self):
+        return True
+
+    def drop_data(self):
+        pass
+
+    def load_data(self, record):
+        pass
+
+    # Transactions with the same coalesce key may be sent in one request,
+    # with `flush_batch`
+    def get_coalesce_key(self):
+        return None
+
+    def flush_batch(self, batch):
+        """ Send the transactions of `batch`, `self` included, at once. """
+        raise NotImplementedError("To be implemented in a subclass")
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
-       are all commited, without exceeding parameters (throttling, memory consumption) """
+       are all commited, without exceeding parameters (throttling, memory consumption)
+
+       Up to `max_in_flight` requests are sent at once. Sends are rate
+       limited by a token bucket: one token every `throttling_delay`, up to
+       `max_burst` tokens.
+
+       With a `store` (a `utils.segment_store.SegmentStore`), transactions
+       are written to disk until they succeed, and the store's disk budget
+       replaces `max_queue_size`. Past `max_memory_size` bytes, the data of
+       the transactions waiting for a replay is only kept on disk.
+
+       Due transactions with the same coalesce key are sent in batches of up
+       to `max_batch_size` bytes of payload. """
 
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
+                 max_in_flight=1, max_burst=1, store=None, max_memory_size=None,
+                 max_batch_size=0):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        self._MAX_IN_FLIGHT = max(1, int(max_in_flight))
+        self._MAX_BATCH_SIZE = int(max_batch_size)
+
+        # Token bucket, empty at first
+        delay = throttling_delay.total_seconds()
+        self._send_rate = 1 / delay if delay > 0 else None
+        self._max_burst = max(1, int(max_burst))
+        self._tokens = 0
+        self._tokens_time = time.time()
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = [] #List of all non commited transactions
+        self._store = store
+        self._max_memory_size = max_memory_size if max_memory_size is not None else max_queue_size
+        self._memory_size = 0 # Size of the transactions held in memory
+        self._locations = {} # Store locations by transaction id, and the reverse
+        self._location_ids = {}
+        self._hot_ids = [] # Heap of the ids of the stored transactions with their data in memory
+        self._last_sync = time.time()
+
+        self._transactions = {} # All non commited transactions, by id
+        # Heaps of [flush key, id, version] entries, by next flush time and
+        # by latest next flush time first for the evictions. An entry is
+        # stale once its transaction is gone or got a new version, i.e. a
+        # new next flush time.
+        self._flush_heap = []
+        self._eviction_heap = []
+        self._versions = {}
         self._total_count = 0 # Maintain size/count not to recompute it everytime
         self._total_size = 0 
+        self._size_by_type = {} # [count, size] by transaction type
         self._flush_count = 0
         self._transactions_received = 0
         self._transactions_flushed = 0
@@ -84,13 +169,150 @@ class TransactionManager(object):
         self._counter = 0
 
         self._trs_to_flush = None # Current transactions being flushed
-        self._last_flush = datetime.now() # Last flush (for throttling)
+        self._in_flight = set() # Ids of the transactions waiting for a response
+        # Ids of the transactions of each request waiting for a response, a
+        # set shared by the transactions sent together
+        self._requests = {}
+        self._requests_in_flight = 0
+        self._flush_next_scheduled = False
+
+        # Transactions flushed per second, since the previous flush
+        self._drain_rate = 0
+        self._last_drain = (time.time(), 0)
 
         # Track an initial status message.
         ForwarderStatus().persist()
 
     def get_transactions(self):
-        return self._transactions
+        return [self._transactions[tr_id] for tr_id in sorted(self._transactions)]
+
+    def _schedule(self, tr):
+        """ Index `tr` under its current next flush time. """
+        tr_id = tr.get_id()
+        version = self._versions.get(tr_id, 0) + 1
+        self._versions[tr_id] = version
+        key = tr.get_flush_key()
+        heapq.heappush(self._flush_heap, (key, tr_id, version))
+        heapq.heappush(self._eviction_heap, (-key, tr_id, version))
+
+        if len(self._flush_heap) + len(self._eviction_heap) > 4 * len(self._transactions) + HEAP_COMPACTION_SLACK:
+            self._compact()
+
+    def _is_current(self, entry):
+        return self._versions.get(entry[1]) == entry[2]
+
+    def _compact(self):
+        self._flush_heap = [e for e in self._flush_heap if self._is_current(e)]
+        self._eviction_heap = [e for e in self._eviction_heap if self._is_current(e)]
+        heapq.heapify(self._flush_heap)
+        heapq.heapify(self._eviction_heap)
+
+    def _remove(self, tr_id):
+        tr = self._transactions.pop(tr_id, None)
+        if tr is None:
+            return None
+        del self._versions[tr_id]
+        self._total_count -= 1
+        self._total_size -= tr.get_size()
+        self._memory_size -= tr.get_size()
+        if not tr.has_data():
+            self._memory_size += tr.get_data_size()
+        type_size = self._size_by_type[tr.get_type()]
+        type_size[0] -= 1
+        type_size[1] -= tr.get_size()
+        if not type_size[0]:
+            del self._size_by_type[tr.get_type()]
+        location = self._locations.pop(tr_id, None)
+        if location is not None:
+            del self._location_ids[location]
+            self._store.discard(location)
+        return tr
+
+    def _release_memory(self):
+        """ Past the memory budget, keep the data of the oldest stored
+        transactions on disk only. The newest ones are sent first. """
+        hot_ids = self._hot_ids
+        in_flight = []
+        while hot_ids and self._memory_size > self._max_memory_size:
+            tr_id = heapq.heappop(hot_ids)
+            tr = self._transactions.get(tr_id)
+            if tr is None or not tr.has_data() or tr_id not in self._locations:
+                continue
+            if tr_id in self._in_flight:
+                in_flight.append(tr_id)
+                continue
+            tr.drop_data()
+            self._memory_size -= tr.get_data_size()
+        for tr_id in in_flight:
+            heapq.heappush(hot_ids, tr_id)
+
+        if len(hot_ids) > 2 * len(self._transactions) + HEAP_COMPACTION_SLACK:
+            self._hot_ids = [tr_id for tr_id, tr in self._transactions.iteritems()
+                             if tr_id in self._locations and tr.has_data()]
+            heapq.heapify(self._hot_ids)
+
+    def _load_data(self, tr):
+        if self._store is not None and not tr.has_data() and tr.get_id() in self._locations:
+            tr.load_data(self._store.read(self._locations[tr.get_id()]))
+            self._memory_size += tr.get_data_size()
+            heapq.heappush(self._hot_ids, tr.get_id())
+
+    def _store_append(self, tr):
+        """ Write `tr` to the store, returns whether it worked. """
+        try:
+            location, dropped = self._store.append(tr.serialize())
+        except Exception:
+            log.exception("Unable to write transaction %s to the disk queue" % tr.get_id())
+            return False
+        for dropped_location in dropped:
+            tr_id = self._location_ids.pop(dropped_location, None)
+            if tr_id is not None:
+                del self._locations[tr_id]
+                self._remove(tr_id)
+                log.warn("Removed transaction %s from queue" % tr_id)
+        self._locations[tr.get_id()] = location
+        self._location_ids[location] = tr.get_id()
+        return True
+
+    def _add(self, tr):
+        self._transactions[tr.get_id()] = tr
+        self._schedule(tr)
+        self._total_count += 1
+        self._total_size += tr.get_size()
+        self._memory_size += tr.get_size()
+        type_size = self._size_by_type.setdefault(tr.get_type(), [0, 0])
+        type_size[0] += 1
+        type_size[1] += tr.get_size()
+        if tr.get_id() in self._locations:
+            heapq.heappush(self._hot_ids, tr.get_id())
+            self._release_memory()
+
+    def replay(self, loader):
+        """ Queue back the transactions left in the store by a previous run.
+        `loader` builds a transaction from its record, or returns None. """
+        if self._store is None:
+            return
+        count = 0
+        for location, record in self._store.replay():
+            try:
+                tr = loader(record)
+            except Exception:
+                log.exception("Unable to load a transaction from the disk queue")
+                tr = None
+            if tr is None:
+                self._store.discard(location)
+                continue
+            tr.set_id(self.get_tr_id())
+            self._locations[tr.get_id()] = location
+            self._location_ids[location] = tr.get_id()
+            self._add(tr)
+            count += 1
+        if count:
+            log.info("Replaying %s transaction%s from the disk queue" % (count, plural(count)))
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" % 
@@ -111,21 +333,21 @@ class TransactionManager(object):
         log.debug("New transaction to add, total size of queue would be: %s KB" % 
             ((self._total_size + tr_size)/ 1024))
 
-        if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+        # Without a store, or when it fails, the queue is bounded in memory
+        stored = self._store is not None and self._store_append(tr)
+        if not stored and (self._memory_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            # The transactions that would be flushed last go first
+            eviction_heap = self._eviction_heap
+            while eviction_heap and (self._memory_size + tr_size) > self._MAX_QUEUE_SIZE:
+                entry = heapq.heappop(eviction_heap)
+                if self._is_current(entry):
+                    self._remove(entry[1])
+                    log.warn("Removed transaction %s from queue" % entry[1])
 
         # Done
-        self._transactions.append(tr)
-        self._total_count +=  1
+        self._add(tr)
         self._transactions_received += 1
-        self._total_size = self._total_size + tr_size
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
@@ -138,10 +360,17 @@ class TransactionManager(object):
 
         to_flush = []
         # Do we have something to do ?
-        now = datetime.now()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        now = time.time()
+        flush_heap = self._flush_heap
+        due = []
+        while flush_heap and flush_heap[0][0] < now:
+            entry = heapq.heappop(flush_heap)
+            if self._is_current(entry):
+                due.append(entry)
+                to_flush.append(self._transactions[entry[1]])
+        # They stay due until they succeed or get rescheduled by an error
+        for entry in due:
+            heapq.heappush(flush_heap, entry)
 
         count = len(to_flush)
         should_log = self._flush_count +1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -164,59 +393,144 @@ class TransactionManager(object):
 
         self._flush_count += 1
 
+        now = time.time()
+        if self._store is not None and now - self._last_sync >= STORE_SYNC_INTERVAL:
+            self._store.sync()
+            self._last_sync = now
+
+        last_time, last_flushed = self._last_drain
+        if now > last_time:
+            self._drain_rate = round((self._transactions_flushed - last_flushed) / (now - last_time), 2)
+        self._last_drain = (now, self._transactions_flushed)
+
         ForwarderStatus(
             queue_length=self._total_count,
             queue_size=self._total_size,
+            queue_disk_size=self._store.size() if self._store is not None else 0,
+            queue_memory_size=self._memory_size,
+            queue_size_by_type=dict((tr_type, tuple(type_size))
+                                    for tr_type, type_size in self._size_by_type.iteritems()),
             flush_count=self._flush_count,
             transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed).persist()
+            transactions_flushed=self._transactions_flushed,
+            transactions_in_flight=len(self._in_flight),
+            drain_rate=self._drain_rate).persist()
+
+    def _take_token(self):
+        """ Take a token from the bucket. Returns 0 if there was one, or the
+        number of seconds until there is one. """
+        if self._send_rate is None:
+            return 0
+        now = time.time()
+        self._tokens = min(self._max_burst, self._tokens + (now - self._tokens_time) * self._send_rate)
+        self._tokens_time = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._send_rate
 
     def flush_next(self):
+        trs_to_flush = self._trs_to_flush
+        if trs_to_flush is None:
+            return
 
-        if len(self._trs_to_flush) > 0:
-
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.now()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
-                delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
-
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.now()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+        while trs_to_flush and self._requests_in_flight < self._MAX_IN_FLIGHT:
+            delay = self._take_token()
+            if delay > 0:
                 # Wait a little bit more
                 tornado_ioloop = get_tornado_ioloop()
-                if  tornado_ioloop._running:
-                    tornado_ioloop.add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                if tornado_ioloop._running:
+                    if not self._flush_next_scheduled:
+                        self._flush_next_scheduled = True
+                        tornado_ioloop.add_timeout(time.time() + delay, self._scheduled_flush_next)
+                    return
                 elif self._flush_without_ioloop:
-                    # Tornado is no started (ie, unittests), do it manually: BLOCKING                    
+                    # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
-                    self.flush_next()
-        else:
+                    continue
+                return
+
+            tr = trs_to_flush.pop()
+            batch = [tr]
+            try:
+                self._load_data(tr)
+                batch = self._take_batch(tr, trs_to_flush)
+                self._start_request(batch)
+                if len(batch) > 1:
+                    log.debug("Flushing transactions %s in one batch" % ", ".join(str(t.get_id()) for t in batch))
+                    tr.flush_batch(batch)
+                else:
+                    log.debug("Flushing transaction %d" % tr.get_id())
+                    tr.flush()
+            except Exception,e :
+                log.exception(e)
+                for batch_tr in batch:
+                    self.tr_error(batch_tr)
+
+        if not trs_to_flush and not self._in_flight and self._trs_to_flush is trs_to_flush:
             self._trs_to_flush = None
 
+    def _take_batch(self, tr, trs_to_flush):
+        """ `tr` and the transactions to flush it can be sent with, taken
+        out of `trs_to_flush`. Bounded by the merged payload size, so that
+        `flush_batch` stays short. """
+        key = tr.get_coalesce_key()
+        if key is None or not self._MAX_BATCH_SIZE:
+            return [tr]
+
+        batch = [tr]
+        size = tr.get_batch_size()
+        remaining = []
+        for other in reversed(trs_to_flush):
+            if other.get_coalesce_key() == key and size < self._MAX_BATCH_SIZE:
+                self._load_data(other)
+                other_size = other.get_batch_size()
+                if size + other_size <= self._MAX_BATCH_SIZE:
+                    batch.append(other)
+                    size += other_size
+                    continue
+            remaining.append(other)
+        if len(batch) > 1:
+            remaining.reverse()
+            trs_to_flush[:] = remaining
+        return batch
+
+    def _start_request(self, batch):
+        request = set(tr.get_id() for tr in batch)
+        for tr_id in request:
+            self._in_flight.add(tr_id)
+            self._requests[tr_id] = request
+        self._requests_in_flight += 1
+
+    def _end_in_flight(self, tr_id):
+        """ The transaction got its response, its request is over once all
+        the transactions sent with it did. """
+        self._in_flight.discard(tr_id)
+        request = self._requests.pop(tr_id, None)
+        if request is not None:
+            request.discard(tr_id)
+            if not request:
+                self._requests_in_flight -= 1
+
+    def _scheduled_flush_next(self):
+        self._flush_next_scheduled = False
+        self.flush_next()
+
     def tr_error(self,tr):
+        self._end_in_flight(tr.get_id())
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        if tr.get_id() in self._transactions:
+            self._schedule(tr)
+            self._release_memory()
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
           (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()), 
            tr.get_next_flush()))
 
     def tr_success(self,tr):
         log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count +=  -1
-        self._total_size += - tr.get_size()
+        self._end_in_flight(tr.get_id())
+        self._remove(tr.get_id())
         self._transactions_flushed += 1
         self.print_queue_stats()
 
@@ -13,7 +13,13 @@ import tempfile
 import re
 import simplejson as json
 import logging
+from cookielib import DefaultCookiePolicy
 from hashlib import md5
+import threading
+from urlparse import urlsplit
+
+# 3p
+import requests
 
 # Tornado
 from tornado import ioloop
@@ -38,6 +44,11 @@ log = logging.getLogger(__name__)
 
 NumericTypes = (float, int, long)
 
+# Connections kept open per destination, and seconds after which the
+# connections of an unused destination are closed
+HTTP_POOL_SIZE = 4
+HTTP_IDLE_TIMEOUT = 60
+
 def plural(count):
     if count == 1:
         return ""
@@ -557,6 +568,133 @@ class Timer(object):
         return self._now() - self.started
 
 
+class HTTPSessionPool(object):
+    """
+    Keep-alive HTTP sessions, one per destination (scheme, host and port)
+    and TLS settings, each keeping up to `pool_size` connections open. The sessions of the
+    destinations unused for `idle_timeout` seconds are closed, unless a
+    request is still in progress on them.
+
+    `get`, `post` and `request` take the arguments of their `requests`
+    counterparts. Cookies aren't kept from one request to the next, as with
+    `requests.get`.
+    """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, idle_timeout=HTTP_IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        # Sessions and time of their last use, by destination
+        self.sessions = {}
+        self.last_used = {}
+        # Requests in progress by destination
+        self.in_use = {}
+        self.lock = threading.Lock()
+        self.closed_stats = {'requests': 0, 'connections': 0}
+
+    def session(self, url, verify=True, cert=None):
+        """ The session of the destination of `url`. A connection opened
+        with some certificate settings isn't reused with others. """
+        key = self._key(url, verify, cert)
+        with self.lock:
+            return self._session(key)
+
+    @staticmethod
+    def _key(url, verify, cert):
+        scheme, netloc = urlsplit(url)[:2]
+        return scheme.lower(), netloc.lower(), verify, cert
+
+    def _session(self, key):
+        now = time.time()
+        self._evict_idle(now)
+        session = self.sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.sessions[key] = session
+        self.last_used[key] = now
+        return session
+
+    def request(self, method, url, **kwargs):
+        key = self._key(url, kwargs.get('verify', True), kwargs.get('cert'))
+        with self.lock:
+            session = self._session(key)
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+        try:
+            return session.request(method, url, **kwargs)
+        finally:
+            with self.lock:
+                count = self.in_use.pop(key) - 1
+                if count:
+                    self.in_use[key] = count
+                if key in self.last_used:
+                    self.last_used[key] = time.time()
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def _evict_idle(self, now):
+        for key, last_used in self.last_used.items():
+            if now - last_used > self.idle_timeout and key not in self.in_use:
+                self._close(key)
+
+    def _close(self, key):
+        session = self.sessions.pop(key)
+        del self.last_used[key]
+        stats = self._session_stats(session)
+        self.closed_stats['requests'] += stats['requests']
+        self.closed_stats['connections'] += stats['connections']
+        session.close()
+
+    @staticmethod
+    def _session_stats(session):
+        stats = {'requests': 0, 'connections': 0}
+        for adapter in set(session.adapters.values()):
+            managers = [adapter.poolmanager] + adapter.proxy_manager.values()
+            for manager in managers:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        stats['requests'] += pool.num_requests
+                        stats['connections'] += pool.num_connections
+        return stats
+
+    def stats(self):
+        """ Number of open sessions, and of requests and connections opened
+        since the start. Requests over `reused` connections didn't have to
+        connect. """
+        with self.lock:
+            stats = dict(self.closed_stats, sessions=len(self.sessions))
+            for session in self.sessions.itervalues():
+                for name, count in self._session_stats(session).iteritems():
+                    stats[name] += count
+        stats['reused'] = stats['requests'] - stats['connections']
+        return stats
+
+    def close(self):
+        with self.lock:
+            for key in self.sessions.keys():
+                self._close(key)
+
+
+_http_sessions = None
+_http_sessions_lock = threading.Lock()
+
+def get_http_sessions():
+    """ The HTTPSessionPool shared by the whole process. """
+    global _http_sessions
+    with _http_sessions_lock:
+        if _http_sessions is None:
+            _http_sessions = HTTPSessionPool()
+    return _http_sessions
+
+
 class Platform(object):
     """
     Return information about the given platform.
@@ -0,0 +1,215 @@
+# stdlib
+import logging
+import os
+import struct
+import zlib
+
+log = logging.getLogger(__name__)
+
+# Size after which a new segment file is started
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Record header: kind, payload length and payload crc32
+RECORD_HEADER = struct.Struct('>cIi')
+RECORD = 'R'
+# Payload of an acknowledgement: segment and offset of the acknowledged record
+ACK = 'A'
+ACK_PAYLOAD = struct.Struct('>QQ')
+
+SEGMENT_SUFFIX = '.seg'
+
+
+class SegmentStore(object):
+    """
+    An append-only store of records, kept in segment files of about
+    `segment_size` bytes in `path`. Records are identified by their location,
+    a (segment, offset) tuple, and stay until they are acknowledged with
+    `discard`; acknowledgements are appended to the log too, so that `replay`
+    only returns the records still pending after a restart. A segment file is
+    deleted once all of its records are acknowledged.
+
+    The files take at most `max_size` bytes: past it the oldest segment is
+    dropped, along with its pending records. Writes are only fsync'ed by
+    `sync`, for the caller to batch them.
+
+    Acknowledgements written in a segment deleted before the records they
+    acknowledge may be lost on a crash, these records are then replayed
+    again.
+    """
+
+    def __init__(self, path, max_size, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.max_size = int(max_size)
+        # At least a few segments fit in the budget
+        self.segment_size = max(1, min(int(segment_size), self.max_size // 4))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Size of each segment and offsets of its pending records
+        self.sizes = {}
+        self.pending = {}
+        for name in os.listdir(path):
+            if name.endswith(SEGMENT_SUFFIX):
+                segment = int(name[:-len(SEGMENT_SUFFIX)])
+                self.sizes[segment] = os.path.getsize(self._segment_path(segment))
+                self.pending[segment] = set()
+        self.total_size = sum(self.sizes.itervalues())
+
+        self.current = None
+        self.current_file = None
+        self.dirty = False
+        self.read_files = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+    def _read_records(self, segment, with_payloads=False):
+        """ Records of a segment, as (offset, kind, payload) tuples. The
+        payloads of the `RECORD` ones are only read if `with_payloads`. Stops
+        at the first truncated or corrupt record. """
+        with open(self._segment_path(segment), 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                kind, length, crc = RECORD_HEADER.unpack(header)
+                if kind == RECORD and not with_payloads:
+                    f.seek(length, os.SEEK_CUR)
+                    payload = None
+                    if f.tell() > self.sizes[segment]:
+                        break
+                else:
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        break
+                yield offset, kind, payload
+                offset += RECORD_HEADER.size + length
+
+        if offset < self.sizes[segment]:
+            log.warning("Ignoring the end of the segment %s, from offset %s" % (segment, offset))
+
+    def replay(self):
+        """ Locations and payloads of the records pending from a previous
+        run, oldest first. To be called before any `append`. """
+        acked = set()
+        for segment in sorted(self.sizes):
+            for offset, kind, payload in self._read_records(segment):
+                if kind == RECORD:
+                    self.pending[segment].add(offset)
+                elif kind == ACK:
+                    acked.add(ACK_PAYLOAD.unpack(payload))
+
+        for segment, offset in acked:
+            self.pending.get(segment, set()).discard(offset)
+        for segment in sorted(self.sizes):
+            if not self.pending[segment]:
+                self._delete(segment)
+
+        for segment in sorted(self.sizes):
+            pending = self.pending[segment]
+            for offset, kind, payload in self._read_records(segment, with_payloads=True):
+                if kind == RECORD and offset in pending:
+                    yield (segment, offset), payload
+
+    def append(self, payload):
+        """ Append a record. Returns its location, and the locations of the
+        pending records dropped to make room for it. """
+        dropped = []
+        size = RECORD_HEADER.size + len(payload)
+        while self.total_size + size > self.max_size and len(self.sizes) > 1:
+            oldest = min(self.sizes)
+            if oldest == self.current:
+                break
+            dropped += [(oldest, offset) for offset in sorted(self.pending[oldest])]
+            log.warning("Disk queue is full, dropping segment %s and its %s records" % (oldest, len(self.pending[oldest])))
+            self._delete(oldest)
+
+        location = self._write(RECORD, payload)
+        self.pending[location[0]].add(location[1])
+        return location, dropped
+
+    def discard(self, location):
+        """ Acknowledge a record, it won't be replayed. """
+        segment, offset = location
+        pending = self.pending.get(segment)
+        if pending is None or offset not in pending:
+            return
+        pending.discard(offset)
+        if not pending and segment != self.current:
+            self._delete(segment)
+        else:
+            self._write(ACK, ACK_PAYLOAD.pack(segment, offset))
+
+    def read(self, location):
+        """ Payload of a pending record. """
+        segment, offset = location
+        f = self.read_files.get(segment)
+        if f is None:
+            if segment == self.current:
+                self.current_file.flush()
+            f = self.read_files[segment] = open(self._segment_path(segment), 'rb')
+        f.seek(offset)
+        kind, length, crc = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        payload = f.read(length)
+        if kind != RECORD or zlib.crc32(payload) != crc:
+            raise IOError("Corrupt record at offset %s of segment %s" % (offset, segment))
+        return payload
+
+    def sync(self):
+        """ Make the records appended so far durable. """
+        if self.dirty:
+            self.current_file.flush()
+            os.fsync(self.current_file.fileno())
+            self.dirty = False
+
+    def size(self):
+        return self.total_size
+
+    def close(self):
+        self.sync()
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = None
+        for f in self.read_files.itervalues():
+            f.close()
+        self.read_files = {}
+
+    def _write(self, kind, payload):
+        if self.current is None or self.sizes[self.current] >= self.segment_size:
+            self._rotate()
+        segment = self.current
+        offset = self.sizes[segment]
+        record = RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+        self.current_file.write(record)
+        # Readers of the segment see the buffered writes
+        if segment in self.read_files:
+            self.current_file.flush()
+        self.sizes[segment] += len(record)
+        self.total_size += len(record)
+        self.dirty = True
+        return segment, offset
+
+    def _rotate(self):
+        previous = self.current
+        if previous is not None:
+            self.sync()
+            self.current_file.close()
+        self.current = max(self.sizes.keys() + [0]) + 1
+        self.current_file = open(self._segment_path(self.current), 'ab')
+        self.sizes[self.current] = 0
+        self.pending[self.current] = set()
+        # The previous segment may be all acknowledged already
+        if previous is not None and not self.pending[previous]:
+            self._delete(previous)
+
+    def _delete(self, segment):
+        f = self.read_files.pop(segment, None)
+        if f is not None:
+            f.close()
+        try:
+            os.remove(self._segment_path(segment))
+        except OSError, e:
+            log.warning("Unable to delete the segment %s: %s" % (segment, e))
+        self.total_size -= self.sizes.pop(segment)
+        del self.pending[segment]
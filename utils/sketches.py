@@ -0,0 +1,269 @@
+# stdlib
+from hashlib import md5
+import heapq
+import math
+import struct
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+# Values closer to zero than this are counted as zeros
+MIN_INDEXABLE_VALUE = 1e-9
+
+# 2**14 registers, a standard error of 0.81%
+DEFAULT_HLL_PRECISION = 14
+
+
+class QuantileSketch(object):
+    """
+    A quantile sketch with a relative error guarantee: values are counted in
+    logarithmically sized bins, the value returned for a rank is within
+    `relative_accuracy` of the exact one. Memory is bounded by `max_bins`,
+    past it the lowest bins are collapsed together. Two sketches with the
+    same parameters merge exactly.
+
+    Minimum, maximum, sum and count are kept exactly.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        # Bin counts by key, for positive values and for absolute values of
+        # negative ones
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def _value(self, key):
+        # Middle of the bin (gamma^(key-1), gamma^key], in relative terms
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        if value > MIN_INDEXABLE_VALUE:
+            bins = self.positive
+            key = self._key(value)
+            bins[key] = bins.get(key, 0) + 1
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        elif value < -MIN_INDEXABLE_VALUE:
+            bins = self.negative
+            key = self._key(-value)
+            bins[key] = bins.get(key, 0) + 1
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        else:
+            self.zero_count += 1
+
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _collapse(self, bins):
+        """ Fold the lowest bins into one to get back to `max_bins`. """
+        keys = sorted(bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            bins[target] += bins.pop(key)
+
+    def merge(self, other):
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_bins.iteritems():
+                bins[key] = bins.get(key, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero_count += other.zero_count
+
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def value_at_rank(self, rank):
+        """ The value of the `rank`-th (0-based) smallest value added. """
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+
+        seen = 0
+        negative = self.negative
+        for key in sorted(negative, reverse=True):
+            seen += negative[key]
+            if seen > rank:
+                return self._clamp(-self._value(key))
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+
+        positive = self.positive
+        for key in sorted(positive):
+            seen += positive[key]
+            if seen > rank:
+                return self._clamp(self._value(key))
+
+        return self.max
+
+    def _clamp(self, value):
+        # Bin values are estimates, the extremes are exact
+        return min(max(value, self.min), self.max)
+
+    def __len__(self):
+        return self.count
+
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog cardinality estimator, with a standard error of
+    1.04 / sqrt(2 ** precision) and one byte per register.
+
+    Small sets are counted exactly: the 64 bits hashes of their values are
+    kept until they would take about as much memory as the registers.
+    Two estimators with the same precision merge exactly.
+    """
+
+    def __init__(self, precision=DEFAULT_HLL_PRECISION):
+        self.precision = precision
+        self.register_count = 1 << precision
+        self.sparse_limit = self.register_count // 64
+        self.hashes = set()
+        self.registers = None
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        return struct.unpack_from('<Q', md5(value).digest())[0]
+
+    def add(self, value):
+        if self.registers is None:
+            hashes = self.hashes
+            hashes.add(self._hash(value))
+            if len(hashes) > self.sparse_limit:
+                self._densify()
+        else:
+            self._add_hash(self._hash(value))
+
+    def _add_hash(self, x):
+        precision = self.precision
+        index = x >> (64 - precision)
+        rank = 64 - precision - (x & ((1 << (64 - precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def _densify(self):
+        self.registers = bytearray(self.register_count)
+        for x in self.hashes:
+            self._add_hash(x)
+        self.hashes = None
+
+    def merge(self, other):
+        if other.registers is None:
+            if self.registers is None:
+                self.hashes.update(other.hashes)
+                if len(self.hashes) > self.sparse_limit:
+                    self._densify()
+            else:
+                for x in other.hashes:
+                    self._add_hash(x)
+            return
+
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def __len__(self):
+        if self.registers is None:
+            return len(self.hashes)
+
+        m = self.register_count
+        registers = self.registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(_INVERSE_POWERS_OF_TWO.__getitem__, registers))
+
+        # Linear counting is more accurate for small cardinalities
+        zeros = registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+_INVERSE_POWERS_OF_TWO = [2.0 ** -i for i in xrange(65)]
+
+
+class SpaceSaving(object):
+    """
+    Approximate counts of the most frequent keys of a stream (the
+    "space-saving" algorithm), in bounded memory: at most `capacity` keys are
+    tracked, a new key replaces the least counted one and inherits its count.
+    Counts are overestimated by at most the total count over `capacity`, and
+    any key counted more than that is tracked.
+
+    The least counted key is found through a min-heap of (count, key) entries,
+    one per key. Counts only grow, so entries are refreshed lazily when they
+    reach the top of the heap: an update is O(1) for a tracked key and
+    amortized O(log capacity) for an evicting one.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        # Swapped at once by `pop_top`
+        self._state = ({}, [])
+
+    @property
+    def counts(self):
+        return self._state[0]
+
+    def add(self, key, count=1):
+        counts, heap = self._state
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.capacity:
+            counts[key] = count
+            heapq.heappush(heap, (count, key))
+        else:
+            while True:
+                stale, evicted = heap[0]
+                current = counts[evicted]
+                if current == stale:
+                    break
+                heapq.heapreplace(heap, (current, evicted))
+            del counts[evicted]
+            counts[key] = current + count
+            heapq.heapreplace(heap, (current + count, key))
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.add(key, count)
+
+    def top(self, n=None):
+        """ The `n` most counted keys and their counts, most counted first. """
+        return sorted(self.counts.iteritems(), key=lambda item: item[1], reverse=True)[:n]
+
+    def pop_top(self, n=None):
+        """ Same as `top`, and start counting afresh. Another thread may call
+        `add` meanwhile. """
+        (counts, _), self._state = self._state, ({}, [])
+        # Copying the dict is atomic, iterating over it isn't
+        return sorted(dict(counts).iteritems(), key=lambda item: item[1], reverse=True)[:n]
+
+    def __len__(self):
+        return len(self.counts)